@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+@title: AAA
+
+Fit rational functions to samples of a matrix-valued transfer function,
+e.g. measured on the imaginary axis, with the AAA algorithm:
+
+ Nakatsukasa, Y., Sete, O., and Trefethen, L. N. "The AAA algorithm for
+ rational approximation." SIAM Journal on Scientific Computing 40.3 (2018):
+ A1494-A1522.
+
+All the entries of the matrix share the same support points and weights
+(the set-valued variant of AAA), so the fit has a single set of poles. The
+poles and residues of the fit can then be used to build Potapov products
+without evaluating the original transfer function away from the samples.
+
+"""
+
+import Potapov
+
+import numpy as np
+import numpy.linalg as la
+import scipy.linalg
+
+class AAA_Rational():
+    r'''
+    A rational function in barycentric form,
+
+    .. math::
+        r(z) = \frac{\sum_j w_j F_j / (z - z_j)}{\sum_j w_j / (z - z_j)},
+
+    where the :math:`F_j` are matrices.
+
+    Attributes:
+        support_points (array of complex numbers): the points :math:`z_j`.
+
+        support_values (array): the matrices :math:`F_j`, of shape
+            (number of support points, N, N).
+
+        weights (array of complex numbers): the weights :math:`w_j`.
+
+        errors (list of floats): the largest error on the samples after
+            each step of the fit.
+
+    '''
+    def __init__(self,support_points,support_values,weights,errors=[]):
+        self.support_points = np.asarray(support_points)
+        self.support_values = np.asarray(support_values)
+        self.weights = np.asarray(weights)
+        self.errors = errors
+
+    def evaluate(self,z):
+        '''Evaluate the rational function at many points.
+
+        Args:
+            z (array of complex numbers): points of evaluation.
+
+        Returns:
+            An array of shape z.shape + (N, N).
+        '''
+        z = np.asarray(z,dtype='complex_')
+        shape = self.support_values.shape[1:]
+        zv = z.reshape(-1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            C = 1. / (zv[:,None] - self.support_points[None,:])
+            vals = (np.dot(C*self.weights,
+                           self.support_values.reshape(len(self.weights),-1))
+                    / np.dot(C,self.weights)[:,None])
+        ## exactly at the support points, use the support values.
+        i,j = np.nonzero(zv[:,None] == self.support_points[None,:])
+        vals[i] = self.support_values.reshape(len(self.weights),-1)[j]
+        return vals.reshape(z.shape + shape)
+
+    def __call__(self,z):
+        '''Evaluate the rational function at a single point.
+
+        Args:
+            z (complex number): point of evaluation.
+
+        Returns:
+            (matrix).
+        '''
+        return np.asmatrix(self.evaluate(z))
+
+    def poles(self,):
+        '''Find the poles, as the finite eigenvalues of the arrowhead pencil
+        given by the weights and support points.
+
+        Returns:
+            An array of the poles.
+        '''
+        m = len(self.weights)
+        E = np.zeros((m+1,m+1),dtype='complex_')
+        E[0,1:] = self.weights
+        E[1:,0] = 1.
+        E[1:,1:] = np.diag(self.support_points)
+        B = np.eye(m+1)
+        B[0,0] = 0.
+        evals = scipy.linalg.eigvals(E,B)
+        return evals[np.isfinite(evals)]
+
+    def residues(self,poles=None):
+        r'''Find the residues at the given poles, as
+        :math:`\sum_j w_j F_j / (p - z_j)` divided by the derivative of the
+        denominator :math:`-\sum_j w_j / (p - z_j)^2`.
+
+        Args:
+            poles (optional [array of complex numbers]): the poles. By
+                default all the poles.
+
+        Returns:
+            An array of shape (number of poles, N, N).
+        '''
+        if poles is None:
+            poles = self.poles()
+        poles = np.asarray(poles)
+        C = 1. / (poles[:,None] - self.support_points[None,:])
+        num = np.dot(C*self.weights,
+            self.support_values.reshape(len(self.weights),-1))
+        den_der = -np.dot(C**2,self.weights)
+        return (num / den_der[:,None]).reshape(
+            (len(poles),) + self.support_values.shape[1:])
+
+def aaa(Z,F,tol=1e-13,mmax=100,verbose=False):
+    '''
+    Fit a rational function to the samples F of a matrix-valued function at
+    the points Z with the AAA algorithm.
+
+    Support points are added one by one where the error is largest. After
+    each step the weights are the right singular vector for the smallest
+    singular value of the Loewner matrices of all the entries, stacked.
+
+    Args:
+        Z (array of complex numbers): the sample points, e.g. 1j*omegas.
+
+        F (array): the samples, of shape (len(Z), N, N).
+
+        tol (optional [float]): relative tolerance for the largest error on
+            the samples.
+
+        mmax (optional [int]): maximum number of support points. The
+            rational function has degree at most mmax-1.
+
+        verbose (optional [boolean]): print warnings.
+
+    Returns:
+        The fitted function (AAA_Rational).
+    '''
+    Z = np.asarray(Z,dtype='complex_')
+    F = np.asarray(F,dtype='complex_')
+    if F.ndim == 1:
+        F = F[:,None,None]
+    Fv = F.reshape(len(Z),-1)
+    scale = np.amax(abs(Fv))
+    R = np.tile(Fv.mean(axis=0),(len(Z),1))
+    J = np.ones(len(Z),dtype=bool)
+    support = []
+    errors = []
+    for m in xrange(min(mmax,len(Z)-1)):
+        err = np.amax(abs(Fv - R),axis=1)
+        err[~J] = 0.
+        j = np.argmax(err)
+        support.append(j)
+        J[j] = False
+        zj = Z[support]
+        fj = Fv[support]
+        C = 1. / (Z[J,None] - zj[None,:])
+        ## Loewner matrices of all entries, stacked.
+        A = (Fv[J].T[:,:,None]*C[None,:,:]
+             - C[None,:,:]*fj.T[:,None,:]).reshape(-1,len(support))
+        ## the right singular vectors of A are those of its R factor.
+        _,_,Vh = la.svd(la.qr(A,mode='r'))
+        w = Vh[-1].conj()
+        R = Fv.copy()
+        R[J] = np.dot(C*w,fj) / np.dot(C,w)[:,None]
+        errors.append(np.amax(abs(Fv - R)))
+        if errors[-1] <= tol*scale:
+            break
+    else:
+        if verbose:
+            print "AAA did not converge to the tolerance with mmax =", mmax
+    return AAA_Rational(Z[support],F[support],w,errors)
+
+def aaa_bands(omegas,F,band_width,overlap=None,tol=1e-13,mmax=100):
+    '''
+    Fit separate rational functions to the samples F of a matrix-valued
+    function at the points :math:`z = i \omega` in frequency bands. Each
+    fit uses the samples in its band and in an overlap on either side, so
+    that its poles in the band are well determined.
+
+    The cost of aaa grows quickly with the number of support points, which
+    must exceed the number of poles near the samples. Fitting bands keeps
+    the number of support points of each fit small.
+
+    Args:
+        omegas (array of floats): the frequencies of the samples.
+
+        F (array): the samples, of shape (len(omegas), N, N).
+
+        band_width (float): the width of each band.
+
+        overlap (optional [float]): the width of the extra samples used on
+            either side of each band. By default half of band_width.
+
+        tol, mmax (optional): passed to aaa.
+
+    Returns:
+        A list of pairs of a fit (AAA_Rational) and its band (2-tuple).
+    '''
+    omegas = np.asarray(omegas,dtype=float)
+    F = np.asarray(F)
+    if overlap is None:
+        overlap = band_width / 2.
+    lo,hi = np.amin(omegas),np.amax(omegas)
+    edges = np.r_[np.arange(lo,hi,band_width),hi]
+    fits = []
+    for lower,upper in zip(edges[:-1],edges[1:]):
+        use = (omegas >= lower - overlap) & (omegas <= upper + overlap)
+        fits.append((aaa(1j*omegas[use],F[use],tol,mmax),(lower,upper)))
+    return fits
+
+def get_Potapov_poles_and_vecs(r,residue_tol=1e-8,freq_range=None,eps=1e-7):
+    '''
+    Get the poles and the vectors of the Potapov factors from a fitted
+    rational function. Only poles in the left half plane and in the
+    frequency range of the samples are kept, since the fit does not
+    determine the other poles well. Spurious poles with residues negligible
+    compared to the largest one are dropped.
+
+    Args:
+        r (AAA_Rational or list): the fitted transfer function, or a list
+            of fits and their bands as returned by aaa_bands. In the latter
+            case the poles of each fit are taken from its band.
+
+        residue_tol (optional [float]): relative size of the residues of
+            poles that are dropped.
+
+        freq_range (optional [2-tuple]): (minimum frequency, maximum
+            frequency) of the poles to keep. By default the range of the
+            frequencies of the support points. Not used for a list of fits.
+
+        eps (optional [float]): poles found by neighbouring fits closer
+            than this are identified.
+
+    Returns:
+        Poles, vecs (tuple):
+            An array of the poles, sorted by frequency, and the list of the
+            vectors of the Potapov factors (see Potapov.get_Potapov_vecs).
+    '''
+    if isinstance(r,AAA_Rational):
+        if freq_range is None:
+            freq_range = (np.amin(r.support_points.imag),
+                          np.amax(r.support_points.imag))
+        fits = [(r,freq_range)]
+    else:
+        ## half-open bands, except for the last one.
+        fits = [(fit,(lower,np.nextafter(upper,-np.inf)))
+                for fit,(lower,upper) in r[:-1]] + r[-1:]
+    poles = []
+    residues = []
+    for fit,(lower,upper) in fits:
+        fit_poles = fit.poles()
+        fit_poles = fit_poles[(fit_poles.real < 0) & (fit_poles.imag >= lower)
+                              & (fit_poles.imag <= upper)]
+        poles.append(fit_poles)
+        residues.append(fit.residues(fit_poles))
+    poles = np.concatenate(poles)
+    residues = np.concatenate(residues)
+    order = np.argsort(poles.imag)
+    poles,residues = poles[order],residues[order]
+    ## a pole on the edge between two bands may be found by both fits.
+    keep = np.ones(len(poles),dtype=bool)
+    keep[1:] = abs(np.diff(poles)) > eps
+    poles,residues = poles[keep],residues[keep]
+    sizes = np.amax(abs(residues.reshape(len(poles),-1)),axis=1)
+    keep = sizes > residue_tol*np.amax(sizes) if len(poles) else sizes > 0
+    poles,residues = poles[keep],residues[keep]
+    vecs = Potapov.get_Potapov_vecs(fits[0][0],poles,
+        residues=[np.asmatrix(res) for res in residues])
+    return poles, vecs
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+@title: Collocation
+
+Find the poles of a network with time delays as the eigenvalues of the
+infinitesimal generator of the corresponding delay system.
+
+The state of the network at time t is the content of each delay line,
+:math:`\phi_k(s) = x_k(t+s)` for :math:`s \in [-T_k,0]`, where
+:math:`x_k` is the signal leaving node k. The generator acts as
+:math:`d/ds` on each :math:`\phi_k`, with the boundary condition
+:math:`\phi(0) = M_1 (\phi_1(-T_1),...,\phi_n(-T_n))^T` given by the
+connectivity of the nodes. Its eigenfunctions are
+:math:`\phi_k(s) = a_k e^{zs}` with :math:`a = M_1 E(z) a`, so its
+eigenvalues are exactly the zeros of :math:`\det(I - M_1 E(z))`.
+
+Each delay line is discretized by Chebyshev collocation, which gives a sparse
+generalized eigenvalue problem :math:`L u = z B u`. Eigenvalues near given
+targets are found with a shift-invert sparse eigensolver.
+
+"""
+
+import numpy as np
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sla
+
+def cheb(N):
+    '''
+    Chebyshev differentiation matrix and Chebyshev points on [-1,1],
+    following Trefethen, "Spectral Methods in MATLAB" (2000).
+
+    Args:
+        N (int): polynomial degree. There are N+1 points.
+
+    Returns:
+        D, x (tuple of arrays):
+            The differentiation matrix and the points
+            :math:`x_j = \cos(\pi j / N)`, starting from :math:`x_0 = 1`.
+    '''
+    if N == 0:
+        return np.zeros((1,1)), np.ones(1)
+    x = np.cos(np.pi*np.arange(N+1)/N)
+    c = np.r_[2.,np.ones(N-1),2.] * (-1)**np.arange(N+1)
+    X = np.tile(x,(N+1,1)).T
+    dX = X - X.T
+    D = np.outer(c,1./c) / (dX + np.eye(N+1))
+    D -= np.diag(D.sum(axis=1))
+    return D, x
+
+def delay_generator(M1,delays,ns):
+    '''
+    Discretize the generator of the delay system given by M1 and the delays.
+
+    The kth delay line is represented by its values at ns[k]+1 Chebyshev
+    points on :math:`[-T_k,0]`, starting at :math:`s=0`. The row of each
+    point :math:`s=0` holds the boundary condition, the others the
+    derivative.
+
+    Args:
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats): The delay following each internal node.
+
+        ns (list of ints): The polynomial degree used for each delay.
+
+    Returns:
+        L, B (tuple of sparse matrices):
+            The matrices of the generalized eigenvalue problem
+            :math:`L u = z B u`.
+    '''
+    M1 = np.asarray(M1)
+    sizes = np.asarray(ns) + 1
+    offsets = np.r_[0,np.cumsum(sizes)[:-1]]
+    blocks = []
+    for n,delay in zip(ns,delays):
+        D,x = cheb(n)
+        D = D * (2./delay)
+        D[0] = 0.
+        D[0,0] = 1.
+        blocks.append(D)
+    L = sparse.block_diag(blocks,format='lil').astype(M1.dtype)
+    ends = offsets + sizes - 1  ## the points s = -T_k
+    for k,j in zip(*np.nonzero(M1)):
+        L[offsets[k],ends[j]] -= M1[k,j]
+    b = np.ones(sizes.sum())
+    b[offsets] = 0.
+    return L.tocsr(), sparse.diags(b,format='csr')
+
+def generator_eigenvalues(L,B,targets,k=40):
+    r'''
+    Find the eigenvalues of :math:`L u = z B u` near the given targets.
+
+    For each target :math:`\sigma`, the k largest eigenvalues :math:`\mu` of
+    :math:`(L - \sigma B)^{-1} B` are computed with one sparse LU
+    factorization, and give the eigenvalues :math:`z = \sigma + 1/\mu`
+    closest to :math:`\sigma`.
+
+    Args:
+        L, B (sparse matrices): the matrices of the eigenvalue problem.
+
+        targets (list of complex numbers): where to look for eigenvalues.
+
+        k (optional [int]): number of eigenvalues to find per target.
+
+    Returns:
+        An array of the eigenvalues found.
+    '''
+    size = L.shape[0]
+    k = min(k,size-2)
+    found = []
+    for sigma in targets:
+        lu = sla.splu((L - sigma*B).tocsc())
+        op = sla.LinearOperator((size,size),dtype='complex_',
+            matvec = lambda u: lu.solve(np.asarray(B.dot(u),dtype='complex_')))
+        mus = sla.eigs(op,k=k,return_eigenvectors=False)
+        mus = mus[abs(mus) > 0.]
+        found.append(sigma + 1./mus)
+    if len(found) == 0:
+        return np.zeros(0,dtype='complex_')
+    return np.concatenate(found)
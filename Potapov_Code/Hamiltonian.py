@@ -187,7 +187,8 @@ class Hamiltonian():
                 # print "Delta delays are", self.Delta_delays
         return
 
-    def perturb_roots_z(self,perturb_func,eps = 1e-12):
+    def perturb_roots_z(self,perturb_func,eps = 1e-12,max_count = 10,
+                        vectorized = False,sensitivities = None):
         '''
         One approach to perturbing the roots is to use Newton's method.
         This is done here using a function perturb_func that corresponds to
@@ -195,28 +196,123 @@ class Hamiltonian():
         The function perturb_func is generated in
         get_frequency_pertub_func_z.
 
+        The roots and the adjusted delays of each root are held as arrays,
+        and at each iteration the Newton step is only applied to the roots
+        that have not converged yet.
+
         Args:
             perturb_func (function):
                 The Newton's method function.
 
             eps (optional [float]):
                 Desired precision for convergence.
+
+            max_count (optional [int]):
+                Maximum number of Newton iterations.
+
+            vectorized (optional [boolean]):
+                If True, perturb_func is called once per iteration with an
+                array of the unconverged roots and an array of their delays
+                of shape (number of roots, number of delays). Otherwise it
+                is called separately for each unconverged root.
+
+            sensitivities (optional [array]):
+                The derivatives of the roots by the delays, e.g. the first
+                columns of Time_Delay_Network.get_pole_sensitivities. If
+                given, the roots are first moved by the first-order change
+                due to Delta_delays, so fewer Newton iterations are needed.
+
+        Returns:
+            Convergence information (tuple):
+                A boolean array indicating which roots converged and an
+                integer array with the number of iterations used for each
+                root.
         '''
-        max_count = 10
+        roots = np.asarray(self.roots,dtype='complex_')
+        if sensitivities is not None:
+            self.make_Delta_delays()
+            n = len(self.delays)
+            roots += np.sum(np.asarray(sensitivities)[:,:n]*self.Delta_delays,
+                            axis=1)
+            self.roots[:] = roots.tolist()
+            self._update_omegas()
+        converged = np.zeros(self.m,dtype=bool)
+        counts = np.zeros(self.m,dtype=int)
         for j in range(max_count):
             self.make_Delta_delays() #delays depend on omegas
-            old_roots = copy.copy(self.roots)
-            for i,root in enumerate(self.roots):
-                pert = perturb_func(root,map(sum,zip(self.delays,self.Delta_delays[i])))
-                self.roots[i] += pert
+            active = np.flatnonzero(~converged)
+            Ts = np.asarray(self.delays) + self.Delta_delays[active]
+            if vectorized:
+                pert = np.asarray(perturb_func(roots[active],Ts))
+            else:
+                pert = np.asarray([perturb_func(root,T)
+                    for root,T in zip(roots[active],Ts)])
+            roots[active] += pert
+            counts[active] += 1
+            converged[active] = abs(pert) < eps
+            self.roots[:] = roots.tolist()
             self._update_omegas()
-            if all([abs(new-old) < eps for new,old in zip(self.roots,old_roots)]):
+            if converged.all():
                 print "root adjustment converged!"
                 break
         else:
-            "root adjustment aborted."
+            print "root adjustment aborted."
+        return converged, counts
+
+    def _minimize_roots_z_batched(self,func,dfunc,Ts,max_iter = 50,
+                                  eps = 1e-12):
+        r'''
+        Minimize func for all roots at once using Gauss-Newton steps.
+
+        The function to minimize has the form :math:`F = |f|^2` for an
+        analytic :math:`f`, so the Gauss-Newton step can be written in terms
+        of :math:`F` and its gradient :math:`g = (F_x,F_y)` only:
+        :math:`\delta = -2 F (F_x + i F_y) / |g|^2`. This is the same as the
+        Newton step :math:`-f/f'`. Steps that increase :math:`F` are halved.
+
+        Args:
+            func, dfunc (functions):
+                Functions in x,y,*Ts as in minimize_roots_z. Both are
+                evaluated on arrays of x,y and of each delay.
+
+            Ts (array):
+                Delays to use for each root, with shape
+                (number of roots, number of delays).
+
+            max_iter (optional [int]):
+                Maximum number of Gauss-Newton steps.
+
+            eps (optional [float]):
+                Desired precision for convergence.
 
-    def minimize_roots_z(self,func,dfunc,eps = 1e-12):
+        Returns:
+            Minimized roots (array of complex numbers).
+        '''
+        roots = np.asarray(self.roots,dtype='complex_')
+        active = np.arange(len(roots))
+        for j in range(max_iter):
+            z = roots[active]
+            Ts_active = list(Ts[active].T)
+            F = func(z.real,z.imag,*Ts_active)
+            F_x,F_y = dfunc(z.real,z.imag,*Ts_active)
+            g_sq = F_x**2 + F_y**2
+            step = np.zeros_like(z)
+            nonzero = g_sq > 0
+            step[nonzero] = ( -2.*F[nonzero]*(F_x[nonzero] + 1j*F_y[nonzero])
+                              / g_sq[nonzero] )
+            for k in range(10):
+                z_new = z + step
+                increased = func(z_new.real,z_new.imag,*Ts_active) > F
+                if not increased.any():
+                    break
+                step[increased] /= 2.
+            roots[active] = z + step
+            active = active[abs(step) >= eps]
+            if len(active) == 0:
+                break
+        return roots
+
+    def minimize_roots_z(self,func,dfunc,eps = 1e-12,batched = False):
         '''
         One approach to perturb the roots is to use a function in :math:`x,y`
         that becomes minimized at a zero. This is done here.
@@ -233,19 +329,29 @@ class Hamiltonian():
             eps (optional [float]):
                 Desired precision for convergence.
 
+            batched (optional [boolean]):
+                If True, minimize for all roots at once with batched
+                Gauss-Newton steps (see _minimize_roots_z_batched).
+                Otherwise use scipy.optimize.minimize for each root.
+
         '''
         max_count = 1
         for j in range(max_count):
             self.make_Delta_delays()
             old_roots = copy.copy(self.roots)
-            for i,root in enumerate(self.roots):
-                fun_z = lambda x,y: func(x,y,*map(sum,zip(self.delays,self.Delta_delays[i])))
-                fun_z_2 = lambda arr: fun_z(*arr)
-                dfun_z = lambda x,y: dfunc(x,y,*map(sum,zip(self.delays,self.Delta_delays[i])))
-                dfun_z_2 = lambda arr: dfun_z(*arr)
-                x0 = np.asarray([root.real,root.imag])
-                minimized = minimize(fun_z_2,x0,jac = dfun_z_2).x
-                self.roots[i] = minimized[0] + minimized[1] * 1j
+            if batched:
+                Ts = np.asarray(self.delays) + self.Delta_delays
+                self.roots[:] = self._minimize_roots_z_batched(
+                    func,dfunc,Ts,eps=eps).tolist()
+            else:
+                for i,root in enumerate(self.roots):
+                    fun_z = lambda x,y: func(x,y,*map(sum,zip(self.delays,self.Delta_delays[i])))
+                    fun_z_2 = lambda arr: fun_z(*arr)
+                    dfun_z = lambda x,y: dfunc(x,y,*map(sum,zip(self.delays,self.Delta_delays[i])))
+                    dfun_z_2 = lambda arr: dfun_z(*arr)
+                    x0 = np.asarray([root.real,root.imag])
+                    minimized = minimize(fun_z_2,x0,jac = dfun_z_2).x
+                    self.roots[i] = minimized[0] + minimized[1] * 1j
             #print self.roots
             self._update_omegas()
             if all([abs(new-old) < eps for new,old in zip(self.roots,old_roots)]):
@@ -335,7 +441,9 @@ class Hamiltonian():
 
         '''
         for i,mode in enumerate(self.modes):
-            mode /= functions._norm_of_mode(mode,map(sum, zip(self.delays,self.Delta_delays[i])))
+            ## not in place, since modes of periodic copies may be shared
+            self.modes[i] = mode / functions._norm_of_mode(
+                mode,map(sum, zip(self.delays,self.Delta_delays[i])))
 
     def mode_volumes(self,):
         '''Find the effective volume of each mode to normalize the field.
@@ -411,6 +519,59 @@ class Hamiltonian():
                     chi.start_nonlin, chi.length_nonlin, pm_arr,
                     indices_of_refraction)
 
+    def phase_weights_batch(self,weight_keys,chi):
+        '''The weights of phase_weight for many keys at once, computed with
+        functions.make_nonlinear_interaction_batch.
+
+        As in phase_weight, only the first len(chi.delay_indices) modes of
+        each combination contribute.
+
+        Args:
+            weight_keys (list of tuples):
+                Keys for weights to consider, as in
+                make_phase_matching_weights.
+
+            chi (Chi_nonlin):
+                The chi nonlinearity for which to compute
+                the phase coefficients.
+
+        Returns:
+            Weights (dict or None):
+                A dictionary of weights for the keys, or None if the keys
+                or chi are not of the usual form (combinations and pm_arrs of
+                the same length, at least that of chi.delay_indices, which is a
+                list/tuple, and start_nonlin a number or a list/tuple of the
+                same length).
+
+        '''
+        if not type(chi.delay_indices) in [list,tuple] or not weight_keys:
+            return None
+        k = len(chi.delay_indices)
+        if type(chi.start_nonlin) in [list,tuple]:
+            if len(chi.start_nonlin) != k:
+                return None
+        elif not type(chi.start_nonlin) in [int,float]:
+            return None
+        if not all(len(comb) == len(pm_arr) >= k
+                   for comb,pm_arr in weight_keys):
+            return None
+        combinations = np.array([comb[:k] for comb,_ in weight_keys],
+            dtype=int).reshape(-1,k)
+        pm_arrs = np.array([pm_arr[:k] for _,pm_arr in weight_keys],
+            dtype=int).reshape(-1,k)
+        polarizations_to_use = [self.polarizations[i]
+                                for i in chi.delay_indices]
+        ## the index of refraction of each mode at each position.
+        indices_of_refraction = np.array(
+            [[chi.refraction_index_func((omega,pol))
+              for pol in polarizations_to_use] for omega in self.omegas]
+            ).reshape(self.m,k)
+        values = functions.make_nonlinear_interaction_batch(
+            self.omegas, self.modes, self.delays, chi.delay_indices,
+            chi.start_nonlin, chi.length_nonlin, combinations, pm_arrs,
+            indices_of_refraction[combinations,np.arange(k)])
+        return dict(zip(weight_keys,values))
+
     def make_phase_matching_weights(self,weight_keys,chi,
         filtering_phase_weights = False ,eps = 1e-5):
         '''Make a dict to store the weights for the selected components and the
@@ -437,9 +598,11 @@ class Hamiltonian():
                 phase matching coefficients.
 
         '''
-        weights = {}
-        for comb,pm_arr in weight_keys:
-            weights[comb,pm_arr] = self.phase_weight(comb,pm_arr,chi)
+        weights = self.phase_weights_batch(weight_keys,chi)
+        if weights is None:
+            weights = {}
+            for comb,pm_arr in weight_keys:
+                weights[comb,pm_arr] = self.phase_weight(comb,pm_arr,chi)
         if filtering_phase_weights:
             weights = {k:v for k,v in weights.iteritems() if abs(v) > eps}
         return weights
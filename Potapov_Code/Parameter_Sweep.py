@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+@title: Parameter_Sweep
+
+Follow the poles of a network with time delays while its parameters (e.g.
+reflectivities or delays) change along a path.
+
+The roots for the first value of the parameters are found with one of the
+root-finding methods of Time_Delay_Network. The roots for each next value
+are predicted from the last step (secant predictor) and corrected with
+batched Newton steps on :math:`\det(I - M_1 E(z))`, using its analytic
+logarithmic derivative. A single contour integral around the search
+rectangle then checks whether poles entered it, and only in that case are
+the frequency bands with missing roots searched again.
+
+Independent segments of the path can be swept in parallel.
+
+"""
+
+import Roots
+from functions import delay_det_log_der
+
+import numpy as np
+import numpy.linalg as la
+import multiprocessing
+
+def continue_roots(roots,M1,delays,velocity=None,tol=1e-12,max_iter=20):
+    '''
+    Continue roots of :math:`\det(I - M_1 E(z))` to new values of M1 and
+    the delays.
+
+    Args:
+        roots (array of complex numbers): the roots for the previous values.
+
+        M1 (matrix): The new connectivity matrix among internal nodes.
+
+        delays (list of floats): The new delays.
+
+        velocity (optional [array of complex numbers]): predicted change of
+            each root, added before the Newton steps.
+
+        tol (optional [float]): convergence threshold of Newton's method.
+
+        max_iter (optional [int]): maximum number of Newton steps.
+
+    Returns:
+        Roots, converged (tuple of arrays):
+            The continued roots, and which of them converged.
+    '''
+    M1 = np.asarray(M1)
+    delays = np.asarray(delays,dtype=float)
+    zs = np.asarray(roots,dtype='complex_')
+    if velocity is not None:
+        zs = zs + velocity
+    return Roots.newton_batch(lambda z: 1./delay_det_log_der(z,M1,delays),
+        zs,tol=tol,max_iter=max_iter)
+
+def _step_ratio(p_prev,p_cur,p_next):
+    '''The size of the step from p_cur to p_next, relative to the step from
+    p_prev to p_cur.
+    '''
+    last = la.norm(np.atleast_1d(np.subtract(p_cur,p_prev)).astype(float))
+    if last == 0:
+        return 0.
+    step = la.norm(np.atleast_1d(np.subtract(p_next,p_cur)).astype(float))
+    return step / last
+
+def _merge_found_roots(roots,velocity,found,eps):
+    '''
+    Add the roots found by a new search to the continued roots, sorted by
+    imaginary part. Found roots closer than eps to a continued root are
+    dropped, so that the continued roots and their velocities are kept.
+
+    Args:
+        roots (array of complex numbers): the continued roots, sorted by
+            imaginary part.
+
+        velocity (array of complex numbers): the change of each continued
+            root.
+
+        found (array of complex numbers): the roots found by the search.
+
+        eps (float): roots closer than this are identified.
+
+    Returns:
+        Roots, velocity (tuple of arrays):
+            All the roots sorted by imaginary part, and their velocities
+            (0 for the new roots).
+    '''
+    roots = np.asarray(roots,dtype='complex_')
+    found = Roots.purge_array(found,eps)
+    lower = np.searchsorted(roots.imag,found.imag - eps,side='left')
+    upper = np.searchsorted(roots.imag,found.imag + eps,side='right')
+    new = np.array([not np.any(abs(roots[i:j] - z) < eps)
+                    for z,i,j in zip(found,lower,upper)],dtype=bool)
+    found = found[new]
+    all_roots = np.r_[roots,found]
+    order = np.argsort(all_roots.imag,kind='mergesort')
+    return (all_roots[order],
+            np.r_[velocity,np.zeros(len(found),dtype='complex_')][order])
+
+def next_roots(net,roots,velocity,tol=1e-12,eps=1e-7,N=None,max_iter=20,
+    band_width=None,spacing=None):
+    '''
+    Find the roots of a network in the search rectangle of make_roots, from
+    the roots of a nearby network.
+
+    The roots are continued with continue_roots. Roots that leave the
+    rectangle are dropped. The number of roots in the rectangle is checked
+    with a contour integral, and if poles entered it, the bands where roots
+    are missing are searched again on a grid (see
+    Time_Delay_Network._check_roots_in_bands).
+
+    Args:
+        net (Time_Delay_Network): the new network.
+
+        roots (array of complex numbers): the roots of the nearby network.
+
+        velocity (array of complex numbers): predicted change of each root.
+
+        tol (optional [float]): convergence threshold of Newton's method.
+
+        eps (optional [float]): roots closer than this are identified.
+
+        N (optional [int]): Number of points used along each edge of the
+            contours. By default uses Roots.contour_points_per_edge.
+
+        max_iter (optional [int]): maximum number of Newton steps.
+
+        band_width (optional [float]): the height of the frequency bands
+            searched again.
+
+        spacing (optional [float]): spacing of the grid used to search the
+            bands again. By default about eight points per average distance
+            between roots.
+
+    Returns:
+        Roots, velocity (tuple of arrays):
+            The roots of the new network ordered by frequency, and the
+            change of each root from the nearby network (0 for new roots).
+    '''
+    M1 = np.asarray(net.M1)
+    delays = np.asarray(net.delays,dtype=float)
+    roots = np.asarray(roots,dtype='complex_')
+    freq_range = (net.center_freq - net.max_freq,
+                  net.center_freq + net.max_freq)
+    zs,converged = continue_roots(roots,M1,delays,velocity,tol,max_iter)
+    keep = converged & net._in_search_rect(zs,freq_range)
+    new_roots,index = Roots.purge_array(zs[keep],eps,return_index=True)
+    new_velocity = new_roots - roots[keep][index]
+
+    x_cent,width = -net.max_linewidth/2.,net.max_linewidth/2.
+    N_count = N
+    if N is None:
+        N_count = Roots.contour_points_per_edge(new_roots,x_cent,width,
+            net.max_freq)
+    conj_symmetric = (net.center_freq == 0 and np.all(np.imag(M1) == 0))
+    count = Roots.count_roots_rect(
+        lambda z: delay_det_log_der(z,M1,delays),
+        x_cent,net.center_freq,width,net.max_freq,N_count,conj_symmetric)
+    if (abs(count - round(count.real)) < 0.1
+        and int(round(count.real)) == len(new_roots)):
+        return new_roots, new_velocity
+    ## poles entered the rectangle.
+    if spacing is None:
+        spacing = np.pi / (4.*delays.sum())
+    found = net._check_roots_in_bands(new_roots,freq_range,band_width,N,eps,
+        spacing)
+    return _merge_found_roots(new_roots,new_velocity,found,eps)
+
+def _sweep_segment(args):
+    '''Sweep the roots along a segment of the path, starting with a full
+    search. Takes (factory,params,method,method_kwargs,step_kwargs), for
+    multiprocessing.
+    '''
+    factory,params,method,method_kwargs,step_kwargs = args
+    net = factory(params[0])
+    net.make_roots(method,**method_kwargs)
+    roots = Roots.purge_array(net.roots,step_kwargs.get('eps',1e-7))
+    velocity = np.zeros(len(roots),dtype='complex_')
+    roots_list = [roots]
+    for i in xrange(1,len(params)):
+        ratio = (_step_ratio(params[i-2],params[i-1],params[i])
+                 if i > 1 else 0.)
+        roots,velocity = next_roots(factory(params[i]),roots,ratio*velocity,
+            **step_kwargs)
+        roots_list.append(roots)
+    return roots_list
+
+def sweep_roots(factory,params,method='grid',segments=1,processes=1,
+    tol=1e-12,eps=1e-7,N=None,max_iter=20,band_width=None,spacing=None,
+    **kwargs):
+    '''
+    Find the roots of a family of networks along a path of parameters, in
+    the search rectangle of make_roots.
+
+    The path is split into segments. The roots at the start of each segment
+    are found with make_roots, and are then followed along the segment with
+    next_roots, so that each step costs a few batched Newton iterations and
+    one contour integral.
+
+    Args:
+        factory (function): takes a value of the parameters and returns the
+            Time_Delay_Network. It must be picklable if processes > 1, e.g.
+            a module-level function.
+
+        params (list): the values of the parameters along the path. They
+            can be numbers or arrays, and should change gradually.
+
+        method (optional [string]): the method used by make_roots at the
+            start of each segment.
+
+        segments (optional [int]): number of segments of the path that are
+            swept independently.
+
+        processes (optional [int]): number of processes used to sweep the
+            segments in parallel.
+
+        tol (optional [float]): convergence threshold of Newton's method.
+
+        eps (optional [float]): roots closer than this are identified.
+
+        N (optional [int]): Number of points used along each edge of the
+            contours (see next_roots).
+
+        max_iter (optional [int]): maximum number of Newton steps.
+
+        band_width, spacing (optional [floats]): the height of the frequency
+            bands searched again when poles enter the rectangle, and the
+            spacing of the grid used (see next_roots).
+
+        kwargs: passed to make_roots.
+
+    Returns:
+        A list with the array of the roots for each value of the parameters.
+    '''
+    step_kwargs = {'tol':tol,'eps':eps,'N':N,'max_iter':max_iter,
+                   'band_width':band_width,'spacing':spacing}
+    args = [(factory,[params[i] for i in index],method,kwargs,step_kwargs)
+            for index in np.array_split(np.arange(len(params)),segments)
+            if len(index) > 0]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_sweep_segment,args)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results = map(_sweep_segment,args)
+    return [roots for segment in results for roots in segment]
+
+def iter_sweep_Potapov(factory,params,**kwargs):
+    '''
+    Run the Potapov procedure for a family of networks along a path of
+    parameters, with the roots found by sweep_roots.
+
+    Args:
+        factory (function): takes a value of the parameters and returns the
+            Time_Delay_Network.
+
+        params (list): the values of the parameters along the path.
+
+        kwargs: passed to sweep_roots.
+
+    Yields:
+        (tuple):
+        The value of the parameters and the network, with its roots, vecs,
+        T_testing and spatial_modes made as in run_Potapov.
+    '''
+    for param,roots in zip(params,sweep_roots(factory,params,**kwargs)):
+        net = factory(param)
+        net.Potapov_ran = True
+        net.roots = roots.tolist()
+        net.make_vecs()
+        net.make_T_Testing()
+        net.make_spatial_modes()
+        yield param, net
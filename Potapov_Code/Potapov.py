@@ -77,17 +77,29 @@ def Potapov_prod(z,poles,vecs,N):
         R = R*(np.eye(N) - Pi + Pi * ( z + pole_i.conjugate() )/( z - pole_i) )
     return R
 
-def get_Potapov_vecs(T,poles):
+def get_Potapov_vecs(T,poles,residues=None,found_vecs=None):
     '''
     Given a transfer function T and some poles, compute the residues about the
     poles and generate the eigenvectors to use for constructing the projectors
     in the Blaschke-Potapov factorization.
+
+    If the residues of T are already known (e.g. for a rational fit of T),
+    they can be given instead of being estimated with functions.limit_batch.
+
+    If the vectors of the first poles were already found (e.g. when poles
+    are found a few at a time), they can be given as found_vecs and only
+    the vectors of the remaining poles are computed.
     '''
     N = T(0).shape[0]
-    found_vecs = []
-    for pole in poles:
+    found_vecs = [] if found_vecs is None else list(found_vecs)
+    start = len(found_vecs)
+    if residues is None and len(poles) > start:
+        residues = [None]*start + list(f.limit_batch(T,poles[start:],
+            residue=True))
+    for i in xrange(start,len(poles)):
+        pole = poles[i]
         L = (la.inv(Potapov_prod(pole,poles,found_vecs,N)) *
-            f.limit(lambda z: (z-pole)*T(z),pole) ) ## Current bottleneck O(n^2).
+            np.asmatrix(residues[i]) ) ## Current bottleneck O(n^2).
         [eigvals,eigvecs] = la.eig(L)
         index = np.argmax(map(abs,eigvals))
         big_vec = np.asmatrix(eigvecs[:,index])
@@ -288,3 +300,164 @@ def get_Potapov_ABCD(poles,vecs,T=None,z=None):
         else:
             D = D2*D1
         return [A,B,C,D]
+
+class Periodic_Poles():
+    r'''Class to store a set of poles made of chains of periodic copies.
+
+    Each chain consists of the poles :math:`p_c + i n \tau` for consecutive
+    integers :math:`n`, where :math:`p_c` is the base pole of the chain and
+    :math:`\tau` is the period. All the poles in a chain share the same
+    Potapov vector, so only one vector is stored per base pole. This is the
+    structure of the poles found for commensurate delays.
+
+    The poles are ordered chain by chain, following copy_ranges, and in
+    increasing frequency within each chain.
+
+    Attributes:
+        base_poles (array of complex numbers):
+            The base pole of each chain.
+
+        period (float):
+            Spacing of the poles along the imaginary axis.
+
+        copy_ranges (integer array of shape (number of chains, 3)):
+            Each row is (index of base pole, first n, last n).
+
+        vecs (list of complex-valued column matrices):
+            The Potapov vector of each base pole.
+
+    '''
+    def __init__(self,base_poles,period,copy_ranges,vecs):
+        self.base_poles = np.asarray(base_poles)
+        self.period = period
+        self.copy_ranges = np.asarray(copy_ranges,dtype=int).reshape(-1,3)
+        self.vecs = vecs
+
+    def __len__(self,):
+        return int(self.counts().sum())
+
+    def counts(self,):
+        '''Number of poles in each chain.
+
+        Returns:
+            (integer array).
+        '''
+        return self.copy_ranges[:,2] - self.copy_ranges[:,1] + 1
+
+    def chain_index(self,):
+        '''Index of the base pole of each pole in the set.
+
+        Returns:
+            (integer array).
+        '''
+        return np.repeat(self.copy_ranges[:,0],self.counts())
+
+    def poles(self,):
+        '''Materialize all the poles in the set.
+
+        Returns:
+            (array of complex numbers).
+        '''
+        counts = self.counts()
+        starts = np.repeat(np.cumsum(counts) - counts,counts)
+        ns = (np.repeat(self.copy_ranges[:,1],counts)
+            + np.arange(counts.sum()) - starts)
+        return self.base_poles[self.chain_index()] + 1j*self.period*ns
+
+def Potapov_prod_periodic(z,pole_set,N):
+    r'''
+    The Potapov product for a Periodic_Poles set.
+
+    Consecutive Potapov factors with the same projector :math:`P` combine
+    as :math:`(I - P + P b_1)(I - P + P b_2) = I - P + P b_1 b_2`, so each
+    chain contributes a single matrix factor. The result is the same as
+    Potapov_prod with the materialized poles and vectors.
+
+    Args:
+        z (complex number):
+            value where product is evaluated.
+
+        pole_set (Periodic_Poles):
+            The poles and vectors of the Potapov product.
+
+        N (int):
+            Dimensionality of the the range.
+
+    Returns:
+        (matrix):
+            Complex-valued matrix of size :math:`N \times N`.
+
+    '''
+    R = np.asmatrix(np.eye(N))
+    counts = pole_set.counts()
+    if counts.sum() == 0:
+        return R
+    poles = pole_set.poles()
+    blaschke = (z + poles.conjugate()) / (z - poles)
+    starts = np.cumsum(counts) - counts
+    chain_blaschke = np.multiply.reduceat(blaschke,starts[counts > 0])
+    for i,b in zip(pole_set.copy_ranges[counts > 0,0],chain_blaschke):
+        vec = pole_set.vecs[i]
+        Pi = vec*vec.H
+        R = R*(np.eye(N) - Pi + Pi * b)
+    return R
+
+def get_Potapov_periodic(T,pole_set):
+    '''
+    Same as get_Potapov, but for a Periodic_Poles set.
+
+    Args:
+        T (matrix-valued function):
+            A given meromorphic function.
+
+        pole_set (Periodic_Poles):
+            The poles and vectors of the Potapov product.
+
+    Returns:
+        Potapov product (matrix-valued function):
+            equation to T at z=0 and approximating T
+            using a Potapov product generated by its poles and residues.
+    '''
+    N = T(0).shape[0]
+    return lambda z: T(0)*Potapov_prod_periodic(0,pole_set,N).H*\
+        Potapov_prod_periodic(z,pole_set,N)
+
+def get_Potapov_ABCD_periodic(pole_set,T=None,z=None):
+    r'''
+    Same as get_Potapov_ABCD, but for a Periodic_Poles set.
+
+    The matrices are built directly instead of recursively. The entries of
+    A coupling two poles only depend on the inner product of their vectors,
+    which is taken from the Gram matrix of the base vectors.
+
+    Args:
+        pole_set (Periodic_Poles):
+            The poles and vectors to use.
+
+        T (optional [matrix-valued function]):
+            If given with z, used to estimate D.
+
+        z (optional [complex number]):
+            Location where to estimate D.
+
+    Returns:
+        [A,B,C,D] (list):
+            Four matrices representing the ABCD model.
+    '''
+    ## The states are ordered as in get_Potapov_ABCD, i.e. last pole first.
+    poles = pole_set.poles()[::-1]
+    chains = pole_set.chain_index()[::-1]
+    V = np.hstack(pole_set.vecs)
+    N = V.shape[0]
+    gram = np.asarray(V.H*V)
+    q = np.sqrt( -(poles+poles.conjugate()) )
+    A = np.tril(-np.outer(q,q)*gram[np.ix_(chains,chains)],-1)
+    A[np.diag_indices_from(A)] = poles*gram[chains,chains]
+    A = np.asmatrix(A)
+    B = np.asmatrix(-q[:,None]*np.asarray(V.H)[chains])
+    C = np.asmatrix(np.asarray(V)[:,chains]*q)
+    if T is not None and z is not None:
+        D = estimate_D(A,B,C,T,z)
+    else:
+        D = np.asmatrix(np.eye(N))
+    return [A,B,C,D]
@@ -30,7 +30,9 @@ from itertools import chain
 from scipy import integrate
 import math
 import cmath as cm
+import multiprocessing
 from functions import limit
+from functions import limit_batch
 
 def Muller(x1,x2,x3,f,tol = 1e-12,N=400,verbose=False):
     '''
@@ -117,7 +119,7 @@ def residues(f_frac,roots):
         A list of residues of f_frac.
 
     '''
-    return [limit(lambda z: (z-root)*f_frac(z),root) for root in roots]
+    return list(limit_batch(f_frac,roots,residue=True))
 
 
 
@@ -191,6 +193,71 @@ def new_f_frac_safe(f_frac,z0,residues,roots,max_ok,val=None,verbose=False):
             print 'division by zero in new_f_frac_safe'
         return limit(lambda z: new_f_frac(f_frac,z,residues,roots),z0)
 
+def _subtract_poles(zs,vals,residues,roots,chunk_size=2**20):
+    '''Compute vals - sum_j residues[j]/(zs - roots[j]) for an array of points
+    zs, in chunks of at most chunk_size (point, root) pairs.
+    '''
+    zs = np.asarray(zs,dtype='complex_')
+    out = np.array(vals,dtype='complex_').reshape(-1)
+    zv = zs.reshape(-1)
+    roots = np.asarray(roots,dtype='complex_')
+    residues = np.asarray(residues,dtype='complex_')
+    if len(roots) == 0:
+        return out.reshape(zs.shape)
+    step = max(1,chunk_size // len(roots))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for start in xrange(0,len(zv),step):
+            block = slice(start,start+step)
+            out[block] -= np.dot(1./(zv[block,None] - roots[None,:]),residues)
+    return out.reshape(zs.shape)
+
+def new_f_frac_batch(f_frac,zs,residues,roots,max_ok,vals=None,
+    chunk_size=2**20,verbose=False):
+    '''
+    Same as new_f_frac_safe, but for many points at once. The poles are
+    subtracted at all the points in one broadcasted operation, split into
+    chunks of at most chunk_size (point, root) pairs to bound the memory.
+    Only the points where f_frac is too large, or where the subtraction is
+    not finite, are estimated with the limit function.
+
+    Args:
+        f_frac (function): function for which roots will be subtracted.
+
+        zs (array of complex numbers): points where new_f_frac is evaluated.
+
+        residues (list of complex numbers): The corresponding residues to
+            subtract.
+
+        roots (list of complex numbers): The corresponding roots to subtract.
+
+        max_ok (float) Maximum absolute value of f_frac(z0 to use).
+
+        vals (optional[array of complex numbers]): the values of f_frac at
+            zs, if already known.
+
+        chunk_size (optional[int]): maximum number of (point, root) pairs
+            handled at once.
+
+        verbose (optional[boolean]): print warnings.
+
+    Returns:
+        An array of the new values of f_frac at zs once the chosen poles have
+        been subtracted.
+    '''
+    zs = np.asarray(zs,dtype='complex_')
+    if vals is None:
+        vals = [f_frac(z) for z in zs]
+    vals = np.asarray(vals,dtype='complex_')
+    out = _subtract_poles(zs,vals,residues,roots,chunk_size)
+    flagged = ~(abs(vals) < max_ok) | ~np.isfinite(out)
+    if flagged.any():
+        if verbose:
+            print 'using the limit at',flagged.sum(),'points in new_f_frac_batch'
+        out[flagged] = limit_batch(lambda z: _subtract_poles(z,
+            [f_frac(z_el) for z_el in np.ravel(z)],residues,roots,chunk_size),
+            zs[flagged],vectorized=True)
+    return out
+
 def find_roots(y_smooth,c,num_roots_to_find):
     '''
     given the values y_smooth, locations c, and the number to go up to,
@@ -401,9 +468,8 @@ def get_roots_rect(f,fp,x_cent,y_cent,width,height,N=10,outlier_coeff=100.,
 
     max_ok =  abs(outlier_coeff*get_max(y))
     subtracted_residues = residues(f_frac,subtracted_roots)
-    y_smooth = [new_f_frac_safe(f_frac,z_el,subtracted_residues,
-                                subtracted_roots,max_ok,y_el,verbose)
-                                for y_el,z_el in zip(y,c)]
+    y_smooth = new_f_frac_batch(f_frac,c,subtracted_residues,
+                                subtracted_roots,max_ok,y,verbose=verbose)
     I0 = integrate.trapz(y_smooth, c)  ##approx number of roots not subtracted
 
     ## If there's only a few roots, find them.
@@ -445,3 +511,327 @@ def get_roots_rect(f,fp,x_cent,y_cent,width,height,N=10,outlier_coeff=100.,
             print "max_steps exceeded. Some interior roots might be missing."
 
     return inside_boundary(combined_roots,x_cent,y_cent,width,height)
+
+def purge_array(zs,eps=1e-5,return_index=False):
+    '''
+    Same as purge, but for an array of numbers. The elements are compared
+    after sorting by their imaginary part, so this is fast for many numbers.
+
+    Args:
+        zs (array of complex numbers): elements.
+
+        eps (optional[float]): precision cutoff.
+
+        return_index (optional[boolean]): also return the indices in zs of
+            the elements kept.
+
+    Returns:
+        An array without redundant elements, sorted by imaginary part, and
+        if return_index is True, the array of their indices in zs.
+
+    '''
+    zs = np.asarray(zs,dtype='complex_')
+    order = np.argsort(zs.imag,kind='mergesort')
+    zs = zs[order]
+    keep = np.ones(len(zs),dtype=bool)
+    shift = 1
+    while shift < len(zs):
+        close_imag = zs.imag[shift:] - zs.imag[:-shift] < eps
+        if not close_imag.any():
+            break
+        keep[shift:] &= ~(close_imag & (abs(zs[shift:] - zs[:-shift]) < eps))
+        shift += 1
+    if return_index:
+        return zs[keep], order[keep]
+    return zs[keep]
+
+def newton_batch(step,zs,tol=1e-12,max_iter=50):
+    '''
+    Apply Newton's method to many starting points at once. Only the points
+    that have not converged yet are updated in each iteration.
+
+    Args:
+        step (function): takes an array of points and returns the Newton
+            steps :math:`f/f'` at these points.
+
+        zs (array of complex numbers): starting points.
+
+        tol (optional[float]): convergence threshold for the size of the
+            step.
+
+        max_iter (optional[int]): maximum number of iterations.
+
+    Returns:
+        (tuple of two arrays):
+        The final points and a boolean array for which of them converged.
+
+    '''
+    zs = np.array(zs,dtype='complex_')
+    converged = np.zeros(zs.shape,dtype=bool)
+    active = np.flatnonzero(np.isfinite(zs))
+    for _ in xrange(max_iter):
+        if len(active) == 0:
+            break
+        dz = step(zs[active])
+        finite = np.isfinite(dz)
+        zs[active[finite]] -= dz[finite]
+        done = finite & (abs(dz) < tol)
+        converged[active[done]] = True
+        active = active[finite & ~done]
+    return zs, converged
+
+def count_roots_rect(f_frac,x_cent,y_cent,width,height,N=100,
+    conj_symmetric=False):
+    r'''
+    Estimate the number of roots of f inside a rectangle with the argument
+    principle, :math:`\frac{1}{2 \pi i} \oint f'/f dz`, using the trapezoid
+    rule on the closed boundary.
+
+    If :math:`f(\bar z) = \overline{f(z)}` and the rectangle is symmetric
+    about the real axis, the integral over the lower half of the boundary
+    is minus the conjugate of the integral :math:`I` over the upper half,
+    so only the upper half is evaluated and the count is
+    :math:`\text{Im}(I)/\pi`.
+
+    Args:
+        f_frac (function): takes an array of points and returns
+            :math:`f'/f` at these points.
+
+        x_cent,y_cent (floats): The center of the rectangle in the complex
+            plane.
+
+        width,height (floats): half the width and height of the rectangular
+            region.
+
+        N (optional[int]): Number of points to sample per edge.
+
+        conj_symmetric (optional[boolean]): whether
+            :math:`f(\bar z) = \overline{f(z)}`. Only used if y_cent is 0.
+
+    Returns:
+        The estimated number of roots (complex number). Its distance from
+        the nearest integer indicates the precision.
+
+    '''
+    if conj_symmetric and y_cent == 0:
+        x_min,x_max = x_cent - width,x_cent + width
+        c = np.r_[x_max + 1j*np.linspace(0.,height,N,endpoint=False),
+                  np.linspace(x_max,x_min,N,endpoint=False) + 1j*height,
+                  x_min + 1j*np.linspace(height,0.,N)]
+        return complex(integrate.trapz(f_frac(c),c).imag / np.pi)
+    c = np.asarray(get_boundary(x_cent,y_cent,width,height,N))
+    c = np.r_[c,c[:1]]
+    return integrate.trapz(f_frac(c),c) / (2j*np.pi)
+
+def asymptotic_chain_guesses(coeffs,exponents,freq_range):
+    r'''
+    Predict the roots of an exponential polynomial
+    :math:`f(z) = \sum_j c_j e^{-z \tau_j}` with real exponents.
+
+    For large :math:`|\text{Im}(z)|` the roots lie on chains along the
+    imaginary axis. Each chain comes from an edge of the upper convex hull of
+    the points :math:`(\tau_j,\log|c_j|)`, where the two terms :math:`j,k` at
+    the ends of the edge have the same size. Balancing these two terms gives
+    :math:`z = -(\log(-c_j/c_k) + 2 \pi i n)/(\tau_k - \tau_j)` for integers
+    :math:`n`. The other terms shift the roots, so the predictions should be
+    refined, e.g. with newton_batch.
+
+    Args:
+        coeffs (array of complex numbers): the coefficients :math:`c_j`.
+
+        exponents (array of floats): the exponents :math:`\tau_j`,
+            in increasing order.
+
+        freq_range (2-tuple): (minimum frequency, maximum frequency).
+
+    Returns:
+        An array of predicted roots with imaginary part in freq_range.
+
+    '''
+    logs = np.log(abs(np.asarray(coeffs)))
+    hull = []
+    for k in xrange(len(exponents)):
+        ## drop points that are not above the line to the new point.
+        while len(hull) >= 2:
+            i,j = hull[-2],hull[-1]
+            if ((logs[j]-logs[i])*(exponents[k]-exponents[i]) >
+                (logs[k]-logs[i])*(exponents[j]-exponents[i])):
+                break
+            hull.pop()
+        hull.append(k)
+    guesses = []
+    for j,k in zip(hull[:-1],hull[1:]):
+        d = exponents[k] - exponents[j]
+        log_ratio = np.log(-complex(coeffs[j]) / coeffs[k])
+        ## Im(z) = -(log_ratio.imag + 2 pi n) / d
+        n_min = int(np.ceil((-freq_range[1]*d - log_ratio.imag) / (2.*np.pi)))
+        n_max = int(np.floor((-freq_range[0]*d - log_ratio.imag) / (2.*np.pi)))
+        ns = np.arange(n_min,n_max+1)
+        guesses.append(-(log_ratio + 2j*np.pi*ns) / d)
+    if len(guesses) == 0:
+        return np.zeros(0,dtype='complex_')
+    return np.concatenate(guesses)
+
+def contour_points_per_edge(roots,x_cent,width,height,min_N=100,max_N=100000):
+    r'''
+    Choose the number of points per edge for count_roots_rect. The error of
+    the trapezoid rule decays like :math:`e^{-2 \pi d / h}`, where d is the
+    distance of the roots from the contour and h is the spacing of the
+    points, so the points are spaced by d/2. Only the distance to the
+    vertical edges is used, since these are usually the long ones.
+
+    Args:
+        roots (array of complex numbers): the roots near the rectangle.
+
+        x_cent (float): The real part of the center of the rectangle.
+
+        width,height (floats): half the width and height of the rectangle.
+
+        min_N, max_N (optional[int]): bounds for the number of points.
+
+    Returns:
+        Number of points per edge (int).
+    '''
+    roots = np.asarray(roots)
+    d = width
+    if len(roots) > 0:
+        d = max(np.amin(width - abs(roots.real - x_cent)),1e-12)
+    return int(min(max(min_N,4.*max(width,height)/d),max_N))
+
+def grid_roots_rect(f,f_frac,x_cent,y_cent,width,height,spacing,N=None,
+    tol=1e-12,eps=1e-7,verify=True,max_refine=3,conj_symmetric=False):
+    r'''
+    Find the roots of f in a rectangle from the local minima of
+    :math:`\log|f|` on a grid, which are used as starting points for
+    Newton's method. The number of roots is then checked with
+    count_roots_rect, and the grid is refined if roots are missing.
+
+    This works well when there are many well-separated roots, and f and
+    f_frac can be evaluated on many points at once.
+
+    Args:
+        f (function): takes an array of points and returns the values of f.
+
+        f_frac (function): takes an array of points and returns
+            :math:`f'/f` at these points.
+
+        x_cent,y_cent (floats): The center of the rectangle in the complex
+            plane.
+
+        width,height (floats): half the width and height of the rectangular
+            region.
+
+        spacing (float): spacing of the grid.
+
+        N (optional[int]): Number of points per edge used to count the
+            roots. By default uses contour_points_per_edge.
+
+        tol (optional[float]): convergence threshold of Newton's method.
+
+        eps (optional[float]): roots closer than this are identified.
+
+        verify (optional[boolean]): check the number of roots and refine
+            the grid if needed.
+
+        max_refine (optional[int]): number of times the grid spacing may be
+            halved.
+
+        conj_symmetric (optional[boolean]): passed to count_roots_rect.
+
+    Returns:
+        (tuple):
+        An array of the roots in the rectangle (including the left and
+        bottom edges, excluding the right and top edges), and a boolean for
+        whether their number agrees with the argument principle.
+
+    '''
+    step = lambda z: 1./f_frac(z)
+    roots = np.zeros(0,dtype='complex_')
+    for refine in xrange(max_refine+1):
+        ## one extra point beyond each edge, so roots near edges are seeded.
+        xs = np.arange(x_cent-width-spacing,x_cent+width+2*spacing,spacing)
+        ys = np.arange(y_cent-height-spacing,y_cent+height+2*spacing,spacing)
+        Z = xs[None,:] + 1j*ys[:,None]
+        with np.errstate(divide='ignore'):
+            V = np.log(abs(f(Z)))
+        center = V[1:-1,1:-1]
+        is_min = np.ones(center.shape,dtype=bool)
+        for di in (-1,0,1):
+            for dj in (-1,0,1):
+                if di or dj:
+                    is_min &= center <= V[1+di:V.shape[0]-1+di,
+                                          1+dj:V.shape[1]-1+dj]
+        seeds = Z[1:-1,1:-1][is_min]
+        new_roots,converged = newton_batch(step,seeds,tol=tol)
+        new_roots = new_roots[converged]
+        inside = ((new_roots.real >= x_cent-width)
+                  & (new_roots.real < x_cent+width)
+                  & (new_roots.imag >= y_cent-height)
+                  & (new_roots.imag < y_cent+height))
+        roots = purge_array(np.r_[roots,new_roots[inside]],eps)
+        if not verify:
+            return roots, True
+        if N is None:
+            N_count = contour_points_per_edge(roots,x_cent,width,height)
+        else:
+            N_count = N
+        count = count_roots_rect(f_frac,x_cent,y_cent,width,height,N_count,
+            conj_symmetric)
+        if (abs(count - round(count.real)) < 0.1
+            and int(round(count.real)) == len(roots)):
+            return roots, True
+        spacing /= 2.
+    return roots, False
+
+def _grid_roots_rect_packed(args):
+    '''Call grid_roots_rect with (f,f_frac,(x_cent,y_cent,width,height),
+    kwargs), for multiprocessing.
+    '''
+    f,f_frac,rect,kwargs = args
+    return grid_roots_rect(f,f_frac,*rect,**kwargs)
+
+def iter_grid_roots_tiles(f,f_frac,rects,spacing,processes=1,**kwargs):
+    '''
+    Apply grid_roots_rect to several rectangles, possibly in parallel, and
+    yield the results in the order of the rectangles as they become
+    available.
+
+    Args:
+        f, f_frac (functions): as in grid_roots_rect. These must be
+            picklable if processes > 1, e.g. functools.partial objects of
+            module-level functions.
+
+        rects (list of 4-tuples): (x_cent,y_cent,width,height) of each
+            rectangle.
+
+        spacing (float): spacing of the grid.
+
+        processes (optional[int]): number of processes to use.
+
+        kwargs: passed to grid_roots_rect.
+
+    Yields:
+        The output of grid_roots_rect for the next rectangle.
+
+    '''
+    kwargs['spacing'] = spacing
+    args = [(f,f_frac,rect,kwargs) for rect in rects]
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for result in pool.imap(_grid_roots_rect_packed,args):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for arg in args:
+            yield _grid_roots_rect_packed(arg)
+
+def grid_roots_tiles(f,f_frac,rects,spacing,processes=1,**kwargs):
+    '''
+    Same as iter_grid_roots_tiles, but returns a list with the output of
+    grid_roots_rect for each rectangle.
+    '''
+    return list(iter_grid_roots_tiles(f,f_frac,rects,spacing,processes,
+        **kwargs))
@@ -7,20 +7,31 @@ Created on Mon Mar  2 17:37:37 2015
 """
 import Roots
 import Potapov
+import Collocation
 import numpy as np
 import numpy.linalg as la
+import scipy.sparse as sparse
 import sympy as sp
 import matplotlib.pyplot as plt
 #import mpmath as mp ## for complex-valued plots
 from functions import double_up
 from functions import der
 from functions import Pade
+from functions import pade_state_space
 from functions import spatial_modes
 from functions import gcd_lst
+from functions import delay_det
+from functions import delay_det_log_der
+from functions import delay_det_exponential_terms
+from functions import delay_det_sensitivities
+from functions import limit_batch
 import matplotlib.patches as patches
 from sympy.utilities.autowrap import ufuncify
 
 from decimal import Decimal
+from functools import partial
+import hashlib
+import os
 
 def plot_all(L,dx,labels,colors,lw,name,*args):
     '''
@@ -83,6 +94,17 @@ def plot_all(L,dx,labels,colors,lw,name,*args):
     bbox_inches="tight")
     return
 
+def _replace_file(src,dst):
+    '''Move the file src to dst, replacing dst if it exists.
+
+    On POSIX systems the replacement is atomic. On Windows os.rename fails
+    when dst exists, so dst is removed first, and a crash between the two
+    steps leaves only src.
+    '''
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src,dst)
+
 class Time_Delay_Network():
     '''
     A class to contain the information of a passive linear network with time
@@ -99,6 +121,10 @@ class Time_Delay_Network():
         center_freq (optional [float] ): how much to move the frame up or down
             the complex plane.
 
+        channel_delays (list of floats or None): the delay of each internal
+            node in E(z), when it differs from self.delays, i.e. when E(z) is
+            not diag(exp(-z*delays)). Used by get_Pade_ABCD.
+
     '''
     def __init__(self,max_freq=30.,max_linewidth=1.,N=1000,center_freq = 0.):
         self.max_freq = max_freq
@@ -106,19 +132,616 @@ class Time_Delay_Network():
         self.N = N
         self.Potapov_ran = False
         self.center_freq = center_freq
+        self.pole_set = None
+        self.channel_delays = None
         return
 
     def _make_decimal_delays(self,):
         self.Decimal_delays = map(lambda x: Decimal(str(x)),self.delays)
         self.Decimal_gcd = self._find_commensurate(self.Decimal_delays)
 
-    def make_roots(self):
+    def make_roots(self,method = 'contour',symmetric = False,**kwargs):
         '''Generate the roots given the denominator of the transfer function.
 
+        Args:
+            method (optional [string]): which root-finding method to use.
+                'contour' uses Roots.get_roots_rect. 'near_commensurate'
+                uses make_near_commensurate_roots. 'asymptotic' uses
+                make_asymptotic_roots. 'collocation' uses
+                make_collocation_roots. 'grid' uses make_grid_roots.
+
+            symmetric (optional [boolean]): for a network with real M1 and
+                delays and center_freq 0, only search the upper half of the
+                rectangle and add the conjugates of the roots found there.
+                Only for the 'contour' and 'grid' methods.
+
+            kwargs: passed to the root-finding method.
+
+        '''
+        ## the periodic pole set of make_commensurate_vecs is now stale.
+        self.pole_set = None
+        if symmetric:
+            self._check_conjugate_symmetry()
+            if method not in ('contour','grid'):
+                raise Exception("The symmetric mode is not available for "
+                    "method " + str(method) + ".")
+        if method == 'contour' and symmetric:
+            ## extend the search slightly below the real axis, so that the
+            ## contour does not pass through real roots.
+            margin = 0.05*self.max_freq
+            roots = Roots.get_roots_rect(self.T_denom,self.Tp_denom,
+                -self.max_linewidth/2.,(self.max_freq - margin)/2.,
+                self.max_linewidth/2.,(self.max_freq + margin)/2.,
+                N=self.N,**kwargs)
+            self.roots = self._mirror_roots(roots).tolist()
+        elif method == 'contour':
+            self.roots = Roots.get_roots_rect(self.T_denom,self.Tp_denom,
+                -self.max_linewidth/2.,self.center_freq,
+                self.max_linewidth/2.,self.max_freq,N=self.N,**kwargs)
+        elif method == 'grid':
+            self.make_grid_roots(symmetric = symmetric,**kwargs)
+        elif method == 'near_commensurate':
+            self.make_near_commensurate_roots(**kwargs)
+        elif method == 'asymptotic':
+            self.make_asymptotic_roots(**kwargs)
+        elif method == 'collocation':
+            self.make_collocation_roots(**kwargs)
+        else:
+            raise Exception("Unknown method " + str(method) + ".")
+        return
+
+    def _check_conjugate_symmetry(self,):
+        '''Check that the poles come in conjugate pairs, i.e. that M1 and the
+        delays are real, and that the search rectangle is symmetric about the
+        real axis.
+        '''
+        if (np.any(np.imag(np.asarray(self.M1)) != 0)
+            or np.any(np.imag(np.asarray(self.delays)) != 0)):
+            raise Exception("The symmetric mode requires real M1 and delays.")
+        if self.center_freq != 0:
+            raise Exception("The symmetric mode requires center_freq = 0.")
+
+    def _mirror_roots(self,roots,eps = 1e-7):
+        '''Given the roots in the upper half plane, return them together
+        with their conjugates, ordered by frequency. Roots within eps of the
+        real axis are made real, and those further below it are dropped.
+        '''
+        roots = np.asarray(roots,dtype='complex_')
+        upper = roots[roots.imag > eps]
+        real = roots[abs(roots.imag) <= eps].real + 0j
+        roots = np.r_[upper.conj(),real,upper]
+        return roots[np.argsort(roots.imag,kind='mergesort')]
+
+    def _get_residues(self,poles,known = None):
+        r'''Residues of T at the poles. Using :math:`T(\bar z) =
+        \overline{T(z)}`, the residue at a pole below the real axis is the
+        conjugate of the residue at its mirror image, when that is a pole
+        too.
+
+        Args:
+            poles (list of complex numbers): the poles.
+
+            known (optional [dict]): residues already found, by pole. The
+                new residues are added to it.
+
+        Returns:
+            A list of the residues (matrices).
+        '''
+        if known is None:
+            known = {}
+        new = set(poles) - set(known)
+        mirrored = [pole for pole in new
+                    if pole.imag < 0 and pole.conjugate() in known
+                    or pole.imag < 0 and pole.conjugate() in new]
+        todo = list(new - set(mirrored))
+        for pole,residue in zip(todo,
+            limit_batch(self.T,todo,residue=True) if todo else []):
+            known[pole] = np.asmatrix(residue)
+        for pole in mirrored:
+            known[pole] = known[pole.conjugate()].conjugate()
+        return [known[pole] for pole in poles]
+
+    def _in_search_rect(self,roots,freq_range):
+        '''Mask of roots in the rectangle searched by make_roots, restricted
+        to the half-open frequency range [minimum frequency, maximum
+        frequency).
+        '''
+        return ((roots.real >= -self.max_linewidth) & (roots.real <= 0.)
+            & (roots.imag >= freq_range[0]) & (roots.imag < freq_range[1]))
+
+    def make_near_commensurate_roots(self,denominator = 100,band_width = None,
+        N = None,tol = 1e-12,eps = 1e-7,verify = True):
+        '''
+        Generate the roots in the same rectangle as make_roots, by first
+        approximating the delays by commensurate ones.
+
+        The delays are rounded to integer multiples of 1/denominator. The
+        roots for the rounded delays are found from the commensurate
+        polynomial, and are then continued to the actual delays with
+        batched Newton steps, changing the delays gradually. Finally the
+        number of roots in each frequency band is checked with a contour
+        integral, and bands where roots are missing are searched again with
+        Roots.get_roots_rect.
+
+        Args:
+            denominator (optional [int]): The delays are approximated by
+                fractions with this denominator. Larger values give better
+                starting points, but a polynomial of larger degree.
+
+            band_width (optional [float]): the height of the frequency bands
+                used to check the number of roots. By default each band has
+                about 50 roots.
+
+            N (optional [int]): Number of points used along each edge of the
+                contour of each band (see _check_roots_in_bands).
+
+            tol (optional [float]): convergence threshold of Newton's method.
+
+            eps (optional [float]): roots closer than this are identified.
+
+            verify (optional [boolean]): check the number of roots in each
+                band with a contour integral.
+
+        '''
+        delays = np.asarray(self.delays,dtype=float)
+        M1 = np.asarray(self.M1)
+        ks = np.maximum(np.round(delays*denominator).astype(int),1)
+        k_gcd = gcd_lst(ks.tolist())
+        unit = k_gcd / float(denominator)
+        ks = ks // k_gcd
+        approx_delays = ks * unit
+
+        ## starting points from the commensurate polynomial
+        xs = np.roots(self._make_T_denom_poly_coeffs(ks = ks))
+        base_roots = np.log(xs[xs != 0]) / unit
+        period = 2.*np.pi / unit
+        freq_range = (self.center_freq - self.max_freq,
+                      self.center_freq + self.max_freq)
+        roots,_ = self._find_instances_in_range(base_roots,
+            (freq_range[0] - period, freq_range[1] + period),period)
+
+        ## continuation from the approximated delays to the actual ones
+        max_abs_freq = max(map(abs,freq_range)) + period
+        steps = int(np.ceil(max_abs_freq
+            * np.amax(abs(delays - approx_delays)) / 0.25)) + 1
+        for s in np.linspace(0.,1.,steps+1)[1:]:
+            Ts = approx_delays + s*(delays - approx_delays)
+            roots,converged = Roots.newton_batch(
+                lambda z: 1./delay_det_log_der(z,M1,Ts),roots,
+                tol=tol,max_iter=10 if s < 1. else 50)
+        roots = roots[converged]
+        roots = Roots.purge_array(roots[self._in_search_rect(roots,freq_range)],
+            eps)
+
+        if verify:
+            roots = self._check_roots_in_bands(roots,freq_range,band_width,
+                N,eps)
+        self.roots = roots.tolist()
+        self.pole_set = None
+        return
+
+    def _check_roots_in_bands(self,roots,freq_range,band_width = None,
+        N = None,eps = 1e-7,spacing = None):
+        '''
+        Check the number of roots in each frequency band of the search
+        rectangle with a contour integral. Bands where roots are missing are
+        searched again with Roots.get_roots_rect, or first with
+        Roots.grid_roots_rect if spacing is given.
+
+        Args:
+            roots (array of complex numbers): the roots found so far.
+
+            freq_range (2-tuple): (minimum frequency, maximum frequency)
+                of the bands to check.
+
+            band_width (optional [float]): the height of the frequency bands.
+                By default each band has about 50 roots.
+
+            N (optional [int]): Number of points used along each edge of the
+                contour of each band. By default uses
+                Roots.contour_points_per_edge.
+
+            eps (optional [float]): roots closer than this are identified.
+
+            spacing (optional [float]): spacing of the grid used by
+                Roots.grid_roots_rect.
+
+        Returns:
+            The roots, including the ones found again (array).
+        '''
+        delays = np.asarray(self.delays,dtype=float)
+        M1 = np.asarray(self.M1)
+        if band_width is None:
+            band_width = 100.*np.pi / delays.sum()
+        if N is None:
+            N = Roots.contour_points_per_edge(roots,-self.max_linewidth/2.,
+                self.max_linewidth/2.,band_width/2.)
+        f_frac = lambda z: delay_det_log_der(z,M1,delays)
+        edges = np.r_[np.arange(freq_range[0],freq_range[1],band_width),
+                      freq_range[1]]
+        edges[1:-1] = self._move_edges_between_roots(edges[1:-1],roots)
+        for lower,upper in zip(edges[:-1],edges[1:]):
+            in_band = self._in_search_rect(roots,(lower,upper))
+            count = Roots.count_roots_rect(f_frac,
+                -self.max_linewidth/2.,(lower+upper)/2.,
+                self.max_linewidth/2.,(upper-lower)/2.,N=N)
+            if (abs(count - round(count.real)) < 0.1
+                and int(round(count.real)) == in_band.sum()):
+                continue
+            if spacing is not None:
+                band_roots,ok = Roots.grid_roots_rect(
+                    lambda z: delay_det(z,M1,delays),f_frac,
+                    -self.max_linewidth/2.,(lower+upper)/2.,
+                    self.max_linewidth/2.,(upper-lower)/2.,spacing,eps=eps)
+                if ok:
+                    roots = Roots.purge_array(np.r_[roots[~in_band],
+                        band_roots[self._in_search_rect(band_roots,
+                        (lower,upper))]],eps)
+                    continue
+            band_roots = Roots.get_roots_rect(self.T_denom,self.Tp_denom,
+                -self.max_linewidth/2.,(lower+upper)/2.,
+                self.max_linewidth/2.,(upper-lower)/2.,N=self.N,
+                known_roots=roots[in_band].tolist())
+            roots = Roots.purge_array(np.r_[roots,band_roots],eps)
+        return roots
+
+    def make_collocation_roots(self,points_per_freq = 0.75,k = 40,
+        tol = 1e-12,eps = 1e-7,verify = True):
+        '''
+        Generate the roots in the same rectangle as make_roots, as the
+        eigenvalues of the discretized generator of the delay system (see
+        Collocation).
+
+        The eigenvalues are found near targets along the middle of the
+        rectangle, spaced so that the eigenvalues found for neighbouring
+        targets overlap. They are then polished with batched Newton steps.
+
+        Args:
+            points_per_freq (optional [float]): Each delay :math:`T_k` is
+                discretized with about points_per_freq times
+                :math:`T_k` times the largest frequency collocation points.
+
+            k (optional [int]): number of eigenvalues to find per target.
+
+            tol (optional [float]): convergence threshold of Newton's method.
+
+            eps (optional [float]): roots closer than this are identified.
+
+            verify (optional [boolean]): check the number of roots in each
+                frequency band with a contour integral.
+
+        '''
+        delays = np.asarray(self.delays,dtype=float)
+        M1 = np.asarray(self.M1)
+        freq_range = (self.center_freq - self.max_freq,
+                      self.center_freq + self.max_freq)
+        max_abs_freq = max(map(abs,freq_range))
+        ns = [int(np.ceil(points_per_freq*max_abs_freq*delay)) + 10
+              for delay in delays]
+        L,B = Collocation.delay_generator(M1,delays,ns)
+
+        ## about k/2 roots are within spacing of each target.
+        spacing = k * np.pi / (2.*delays.sum())
+        num_targets = int(np.ceil((freq_range[1]-freq_range[0])/spacing)) + 1
+        targets = (-self.max_linewidth/2. + 1j*np.linspace(freq_range[0],
+            freq_range[1],num_targets))
+        roots = Collocation.generator_eigenvalues(L,B,targets,k)
+        roots,converged = Roots.newton_batch(
+            lambda z: 1./delay_det_log_der(z,M1,delays),roots,tol=tol)
+        roots = roots[converged]
+        roots = Roots.purge_array(roots[self._in_search_rect(roots,freq_range)],
+            eps)
+        if verify:
+            roots = self._check_roots_in_bands(roots,freq_range,eps=eps)
+        self.roots = roots.tolist()
+        self.pole_set = None
+        return
+
+    def make_grid_roots(self,spacing = None,tile_height = None,
+        processes = 1,tol = 1e-12,eps = 1e-7,verify = True,checkpoint = None,
+        symmetric = False):
+        '''
+        Generate the roots in the same rectangle as make_roots, by splitting
+        it into tiles and applying Roots.grid_roots_rect to each tile (see
+        iter_roots).
+
+        Args:
+            spacing (optional [float]): spacing of the grid. By default
+                about eight points per average distance between roots.
+
+            tile_height (optional [float]): height of each tile. By default
+                each tile has about 50 roots.
+
+            processes (optional [int]): number of processes used to work on
+                the tiles in parallel.
+
+            tol (optional [float]): convergence threshold of Newton's method.
+
+            eps (optional [float]): roots closer than this are identified.
+
+            verify (optional [boolean]): check the number of roots in each
+                tile with a contour integral.
+
+            checkpoint (optional [string]): file where the progress is saved
+                after each tile. If the file exists, the search resumes from
+                it (see iter_roots).
+
+            symmetric (optional [boolean]): only search the upper half of
+                the rectangle and mirror the roots (see iter_roots).
+
+        '''
+        bands = self.iter_roots(band_width = tile_height,spacing = spacing,
+            processes = processes,tol = tol,eps = eps,verify = verify,
+            center_out = False,checkpoint = checkpoint,symmetric = symmetric)
+        roots = Roots.purge_array(np.concatenate(
+            [np.zeros(0,dtype='complex_')] + [r for band,r in bands]),eps)
+        self.roots = roots.tolist()
+        self.pole_set = None
+        return
+
+    def iter_roots(self,band_width = None,with_vecs = False,processes = 1,
+        spacing = None,tol = 1e-12,eps = 1e-7,verify = True,
+        center_out = True,checkpoint = None,symmetric = False):
+        '''
+        Generate the roots in the same rectangle as make_roots one frequency
+        band at a time, so that the roots of the first bands can be used
+        while the others are being searched.
+
+        Each band is searched with Roots.grid_roots_rect and the number of
+        its roots is checked with a contour integral. Bands where roots are
+        still missing are searched again with Roots.get_roots_rect.
+
+        Args:
+            band_width (optional [float]): height of each band. By default
+                each band has about 50 roots.
+
+            with_vecs (optional [boolean]): also generate the vectors of the
+                Potapov factors of the roots. The vectors of each band are
+                found given the vectors of the bands before it.
+
+            processes (optional [int]): number of processes used to search
+                the bands in parallel. The bands are still yielded in order.
+
+            spacing (optional [float]): spacing of the grid. By default
+                about eight points per average distance between roots.
+
+            tol (optional [float]): convergence threshold of Newton's method.
+
+            eps (optional [float]): roots closer than this are identified.
+
+            verify (optional [boolean]): check the number of roots in each
+                band with a contour integral.
+
+            center_out (optional [boolean]): start with the bands closest to
+                center_freq. Otherwise go in increasing frequency.
+
+            checkpoint (optional [string]): file where the completed bands
+                and their roots are saved after each band. If the file
+                exists, the bands completed in it are not searched again.
+                The file must have been made for the same network and
+                search rectangle (see network_hash).
+
+            symmetric (optional [boolean]): for a network with real M1 and
+                delays and center_freq 0, only search a band centered on the
+                real axis and the bands above it. The roots of each band
+                below the real axis are the conjugates of those of its
+                mirror image, which is yielded right after it. The residues
+                used for the vectors are mirrored in the same way.
+
+        Yields:
+            (tuple):
+            The band (minimum frequency, maximum frequency), an array of the
+            roots in the band ordered by frequency, and if with_vecs is
+            True, the list of their Potapov vectors.
+        '''
+        delays = np.asarray(self.delays,dtype=float)
+        M1 = np.asarray(self.M1)
+        if spacing is None:
+            spacing = np.pi / (4.*delays.sum())
+        if band_width is None:
+            band_width = 100.*np.pi / delays.sum()
+        freq_range = (self.center_freq - self.max_freq,
+                      self.center_freq + self.max_freq)
+        if symmetric:
+            self._check_conjugate_symmetry()
+            edges = np.r_[np.arange(band_width/2.,freq_range[1],band_width),
+                          freq_range[1]]
+            bands = [(-edges[0],edges[0])] + zip(edges[:-1],edges[1:])
+        else:
+            edges = np.r_[np.arange(freq_range[0],freq_range[1],band_width),
+                          freq_range[1]]
+            bands = zip(edges[:-1],edges[1:])
+        if center_out:
+            bands.sort(key = lambda band: abs(sum(band)/2. - self.center_freq))
+        rects = [(-self.max_linewidth/2.,(lower+upper)/2.,
+                  self.max_linewidth/2.,(upper-lower)/2.)
+                 for lower,upper in bands]
+        search = np.asarray([self.max_linewidth,freq_range[0],freq_range[1],
+                             band_width,spacing,eps,symmetric])
+        completed = {}
+        if checkpoint is not None and os.path.exists(checkpoint):
+            completed = self._load_roots_checkpoint(checkpoint,search)
+        f = partial(delay_det,M1=M1,delays=delays)
+        f_frac = partial(delay_det_log_der,M1=M1,delays=delays)
+        results = Roots.iter_grid_roots_tiles(f,f_frac,
+            [rect for band,rect in zip(bands,rects) if band not in completed],
+            spacing,processes=processes,tol=tol,eps=eps,verify=verify,
+            conj_symmetric=symmetric)
+
+        poles = []
+        vecs = []
+        residues = {}
+        edge_roots = np.zeros(0,dtype='complex_')
+        for band,rect in zip(bands,rects):
+            if band in completed:
+                roots,ok = completed[band],True
+            else:
+                roots,ok = next(results)
+            if not ok:
+                new_roots = Roots.get_roots_rect(self.T_denom,self.Tp_denom,
+                    *rect,N=self.N,known_roots=roots.tolist())
+                roots = Roots.purge_array(np.r_[roots,new_roots],eps)
+            ## roots on the edge between two bands may be found in both.
+            if len(edge_roots) > 0:
+                roots = roots[np.amin(abs(roots[:,None] - edge_roots[None,:]),
+                    axis=1) > eps]
+            near_edges = ((abs(roots.imag - band[0]) < 2*eps)
+                          | (abs(roots.imag - band[1]) < 2*eps))
+            edge_roots = np.r_[edge_roots,roots[near_edges]]
+            if checkpoint is not None and band not in completed:
+                completed[band] = roots
+                self._save_roots_checkpoint(checkpoint,search,completed)
+            if not symmetric:
+                outputs = [(band,roots)]
+            elif band[0] < 0:
+                outputs = [(band,self._mirror_roots(roots,eps))]
+            else:
+                outputs = [(band,roots),((-band[1],-band[0]),roots.conj()[::-1])]
+            for out_band,out_roots in outputs:
+                if with_vecs:
+                    poles.extend(out_roots)
+                    vecs = Potapov.get_Potapov_vecs(self.T,poles,
+                        residues = self._get_residues(poles,residues)
+                            if symmetric else None,
+                        found_vecs = vecs)
+                    yield out_band, out_roots, vecs[len(vecs)-len(out_roots):]
+                else:
+                    yield out_band, out_roots
+
+    def network_hash(self,):
+        '''
+        A hash of the definition of the network, i.e. of M1 and the delays,
+        used to check that saved results belong to this network.
+
+        Returns:
+            Hexadecimal digest (string).
+        '''
+        sha = hashlib.sha1()
+        sha.update(np.ascontiguousarray(self.M1,dtype='complex_').tostring())
+        sha.update(np.ascontiguousarray(self.delays,dtype=float).tostring())
+        return sha.hexdigest()
+
+    def _save_roots_checkpoint(self,checkpoint,search,completed):
+        '''Save the completed bands and their roots. The file is written
+        to a temporary file first, so a crash while saving leaves the
+        previous checkpoint (see _replace_file).
+        '''
+        bands = sorted(completed)
+        roots = [np.zeros(0,dtype='complex_')] + [completed[band]
+                                                  for band in bands]
+        tmp = checkpoint + '.tmp'
+        with open(tmp,'wb') as fh:
+            np.savez(fh,network_hash = self.network_hash(),search = search,
+                bands = np.asarray(bands,dtype=float).reshape(-1,2),
+                counts = [len(completed[band]) for band in bands],
+                roots = np.concatenate(roots))
+        _replace_file(tmp,checkpoint)
+
+    def _load_roots_checkpoint(self,checkpoint,search):
+        '''Load the completed bands and their roots.
+
+        Raises:
+            Exception: The checkpoint must be for the same network and
+            search rectangle.
+        '''
+        with np.load(checkpoint) as data:
+            if str(data['network_hash']) != self.network_hash():
+                raise Exception("Checkpoint " + checkpoint +
+                    " was made for a different network.")
+            if not np.array_equal(data['search'],search):
+                raise Exception("Checkpoint " + checkpoint +
+                    " was made for a different search rectangle or bands.")
+            bands = data['bands']
+            roots = np.split(data['roots'],np.cumsum(data['counts'])[:-1])
+        return {tuple(band): band_roots
+                for band,band_roots in zip(bands,roots)}
+
+    def _move_edges_between_roots(self,edges,roots):
+        '''Move each frequency edge to the middle of the gap between the
+        frequencies of the roots around it, so that contours along the edges
+        stay away from the roots.
+        '''
+        freqs = np.sort(np.asarray(roots).imag)
+        edges = np.asarray(edges,dtype=float)
+        i = np.searchsorted(freqs,edges)
+        inside = (i > 0) & (i < len(freqs))
+        edges[inside] = (freqs[i[inside]-1] + freqs[i[inside]]) / 2.
+        return edges
+
+    def make_asymptotic_roots(self,core_freq = None,band_width = None,
+        N = None,tol = 1e-12,eps = 1e-7,verify = True):
+        '''
+        Generate the roots in the same rectangle as make_roots, predicting
+        the high-frequency roots from the asymptotic chains of
+        :math:`\det(I - M_1 E(z))` (see Roots.asymptotic_chain_guesses).
+
+        The predictions are refined with batched Newton steps, and the
+        number of roots in each frequency band is checked with a contour
+        integral. Only the low-frequency core, where the predictions are
+        poor, is searched with Roots.get_roots_rect.
+
+        Args:
+            core_freq (optional [float]): the roots with frequency in
+                [-core_freq,core_freq) are found with the contour method.
+                By default this covers about five roots of each chain.
+
+            band_width (optional [float]): the height of the frequency bands
+                used to check the number of roots.
+
+            N (optional [int]): Number of points used along each edge of the
+                contour of each band.
+
+            tol (optional [float]): convergence threshold of Newton's method.
+
+            eps (optional [float]): roots closer than this are identified.
+
+            verify (optional [boolean]): check the number of roots in each
+                high-frequency band with a contour integral.
+
         '''
-        self.roots = Roots.get_roots_rect(self.T_denom,self.Tp_denom,
-            -self.max_linewidth/2.,self.center_freq,
-            self.max_linewidth/2.,self.max_freq,N=self.N)
+        delays = np.asarray(self.delays,dtype=float)
+        M1 = np.asarray(self.M1)
+        coeffs,exponents = delay_det_exponential_terms(M1,delays)
+        if core_freq is None:
+            core_freq = 10.*np.pi / exponents[-1]
+        freq_range = (self.center_freq - self.max_freq,
+                      self.center_freq + self.max_freq)
+        core_range = (max(freq_range[0],-core_freq),
+                      min(freq_range[1],core_freq))
+
+        ## the spacing of the roots along any chain is at most this margin
+        margin = 2.*np.pi / np.amin(np.diff(exponents))
+        guesses = Roots.asymptotic_chain_guesses(coeffs,exponents,
+            (freq_range[0] - margin,freq_range[1] + margin))
+        roots,converged = Roots.newton_batch(
+            lambda z: 1./delay_det_log_der(z,M1,delays),guesses,tol=tol)
+        roots = roots[converged]
+        core_range = tuple(np.clip(
+            self._move_edges_between_roots(core_range,roots),*freq_range))
+        in_core = np.zeros(len(roots),dtype=bool)
+        if core_range[0] < core_range[1]:
+            in_core = self._in_search_rect(roots,core_range)
+        roots = Roots.purge_array(
+            roots[self._in_search_rect(roots,freq_range) & ~in_core],eps)
+
+        high_ranges = [(freq_range[0],min(freq_range[1],core_range[0])),
+                       (max(freq_range[0],core_range[1]),freq_range[1])]
+        if verify:
+            for high_range in high_ranges:
+                if high_range[0] < high_range[1]:
+                    roots = self._check_roots_in_bands(roots,high_range,
+                        band_width,N,eps)
+
+        if core_range[0] < core_range[1]:
+            core_roots = np.asarray(Roots.get_roots_rect(self.T_denom,
+                self.Tp_denom,-self.max_linewidth/2.,sum(core_range)/2.,
+                self.max_linewidth/2.,(core_range[1]-core_range[0])/2.,
+                N=self.N),dtype='complex_')
+            core_roots = core_roots[self._in_search_rect(core_roots,
+                core_range)]
+            roots = Roots.purge_array(np.r_[roots,core_roots],eps)
+        self.roots = roots.tolist()
+        self.pole_set = None
         return
 
     def _find_commensurate(self,delays):
@@ -156,6 +779,45 @@ class Time_Delay_Network():
         ## results in spurious roots if the denominator is nontrivial.
         return
 
+    def _make_T_denom_poly_coeffs(self,eps=1e-13,ks=None):
+        r'''
+        Numerically find the coefficients of the polynomial
+        :math:`p(x) = \det(\text{diag}(x^{k_1},...,x^{k_n}) - M_1)`, where
+        :math:`k_i` is the ratio of the ith delay to the gcd of the delays.
+        This is the polynomial T_denom_sym, found without sympy.
+
+        The polynomial is evaluated at the :math:`N`-th roots of unity,
+        where :math:`N - 1` is the degree of the polynomial, and the
+        coefficients are recovered with an FFT.
+
+        Args:
+            eps (optional[float]): coefficients smaller than eps times the
+                largest coefficient are set to zero.
+
+            ks (optional[list of ints]): use these integers for
+                :math:`k_i` instead of the ones given by the delays.
+
+        Returns:
+            Coefficients (array):
+                The coefficients of :math:`p`, starting from the highest
+                degree (as in np.roots).
+        '''
+        if ks is None:
+            self._make_decimal_delays()
+            ks = [int(delay / self.Decimal_gcd)
+                  for delay in self.Decimal_delays]
+        ks = np.asarray(ks)
+        N = ks.sum() + 1
+        M1 = np.asarray(self.M1)
+        phases = np.outer(np.arange(N),ks) % N
+        diags = np.exp(2j*np.pi*phases/N)
+        vals = la.det(diags[:,:,None]*np.eye(len(ks)) - M1)
+        coeffs = np.fft.fft(vals) / N
+        if np.isrealobj(M1):
+            coeffs = coeffs.real
+        coeffs[abs(coeffs) < eps*np.amax(abs(coeffs))] = 0.
+        return coeffs[::-1]
+
     # def get_symbolic_frequency_perturbation_T_and_z(self,simplify = False):
     #     r'''
     #     A method to prepare the symbolic expression T_denom_sym for further
@@ -274,28 +936,75 @@ class Time_Delay_Network():
         f_i =  ufuncify( [x,y]+self.Ts, num_imag)
         return lambda x,y,Ts: f_r(x,y,*Ts)+f_i(x,y,*Ts)*1j
 
-    def get_frequency_pertub_func_z(self,use_ufuncify = True):
+    def _get_lambdified_funcs(self,expressions):
+        '''
+        Takes a list of expressions in terms of z and Ts and returns a
+        numpy function evaluating all of them. Common subexpressions are
+        eliminated once, so that shared terms such as :math:`e^{z T}` are
+        only computed a single time per call.
+
+        Args:
+            expressions (list of sympy expressions): Symbolic expressions.
+
+        Returns:
+            a function in z,Ts that returns a list with the values of the
+            input expressions. Here z may be an array of complex numbers and
+            Ts a list of delays or an array of shape (len(z), len(Ts)).
+        '''
+        replacements, reduced = sp.cse(expressions)
+        args = [self.z] + self.Ts
+        step_funcs = []
+        for sym, sub_expr in replacements:
+            step_funcs.append(sp.lambdify(args, sub_expr, 'numpy'))
+            args = args + [sym]
+        final_funcs = [sp.lambdify(args, expr, 'numpy') for expr in reduced]
+
+        def func(z_num,Ts_num):
+            vals = ( [np.asarray(z_num,dtype='complex_')] +
+                list(np.asarray(Ts_num,dtype='float_').T) )
+            for f in step_funcs:
+                vals.append(f(*vals))
+            return [f(*vals) for f in final_funcs]
+        return func
+
+    def get_frequency_pertub_func_z(self,use_ufuncify = True,
+                                    use_lambdify = False):
         '''
         Generates a function that can be used to perturb roots using
         Newton's method. This function has form :math:`-f(z) / f'(z)`
         when the time delays are held fixed.
 
-        We give two ways to generate the perturbative function. One is
-        by directly plugging in numbers into a sympy expression and the
+        We give three ways to generate the perturbative function. One is
+        by directly plugging in numbers into a sympy expression, the
         second is by using the ufuncify method to creative a wrapper for
-        the function.
+        the function, and the third is by using lambdify to generate
+        numpy code for the function and its derivative.
+
+        The function generated with lambdify is vectorized. It accepts an
+        array of :math:`M` complex numbers and an array of shape
+        :math:`(M,k)` of the delays to use for each of them, and returns
+        the :math:`M` Newton steps at once.
 
         Args:
             use_ufuncify (optional [boolean]): whether to use ufuncify
                 or not.
 
+            use_lambdify (optional [boolean]): whether to use lambdify
+                or not. Takes precedence over use_ufuncify.
+
         Returns:
             Newton's method function (function):
             The function to use for Newton's method in :math:`z`,
             :math:`-f(z) / f'(z)`.
         '''
         sym_freq_pert = self.get_symbolic_frequency_perturbation_z()
-        if not use_ufuncify:
+        if use_lambdify:
+            num_and_denom = self._get_lambdified_funcs(list(sym_freq_pert))
+            def func(z_num,Ts_num):
+                num, denom = num_and_denom(z_num,Ts_num)
+                return - num / denom
+            return func
+        elif not use_ufuncify:
             sym_freq_pert = -sym_freq_pert[0] / sym_freq_pert[1]
             def func(z_num,Ts_num):
                 D = {T:T_num for T,T_num in zip(self.Ts,Ts_num)}
@@ -306,22 +1015,58 @@ class Time_Delay_Network():
             real_imag_func_num = self._get_newtons_func(sym_freq_pert[0])
             real_imag_func_denom = self._get_newtons_func(sym_freq_pert[1])
             def func(z_num,Ts_num):
+                z_num = np.asarray(z_num)
                 x,y = z_num.real,z_num.imag
+                Ts_num = np.asarray(Ts_num).T
                 return - ( real_imag_func_num(x,y,Ts_num) /
                     real_imag_func_denom (x,y,Ts_num) )
             return func
 
-    def get_minimizing_function_z(self,):
+    def get_numeric_frequency_pertub_func_z(self,):
+        r'''
+        Generates a function that can be used to perturb roots using
+        Newton's method, without building any symbolic expressions.
+
+        The function is :math:`-f(z)/f'(z)` for
+        :math:`f(z) = \det(I - M_1 E(z; T_1,...,T_k))`, where :math:`E` is
+        the diagonal matrix with entries :math:`e^{-z T_j}`. It is evaluated
+        numerically using Jacobi's formula :math:`f'/f = \text{tr}(A^{-1}A')`
+        with :math:`A = I - M_1 E`, so there is one LU factorization per root.
+        This scales to networks with many delays, unlike
+        get_frequency_pertub_func_z.
+
+        The inputs are as for get_frequency_pertub_func_z with use_lambdify:
+        an array of :math:`M` complex numbers and an array of shape
+        :math:`(M,k)` with the delays to use for each of them.
+
+        Returns:
+            Newton's method function (function):
+            The function to use for Newton's method in :math:`z`,
+            :math:`-f(z) / f'(z)`.
+        '''
+        M1 = np.asarray(self.M1)
+        return lambda z_num,Ts_num: -1./delay_det_log_der(z_num,M1,Ts_num)
+
+    def get_minimizing_function_z(self,use_ufuncify = True):
         r'''
         Minimizing this function gives the adjusted roots.
 
         Gives a function to minimize, its arguments are
-        :math:`x,y,Ts`. Also gives its derivative.
+        :math:`x,y,Ts`. Also gives its gradient in :math:`x,y`.
+
+        Both functions accept arrays for :math:`x,y` and for each of the
+        delays, so they can be evaluated for many roots at once.
+
+        Args:
+            use_ufuncify (optional [boolean]): whether to use ufuncify
+                or lambdify to generate the numerical functions.
 
         Returns:
-            Minimizing function (function):
+            Minimizing function and its gradient (tuple of functions):
             A function of :math:`x,y,*Ts` to minimize in the two variables,
-            :math:`x,y`.
+            :math:`x,y`, and a function of :math:`x,y,*Ts` returning an
+            array whose two rows are the derivatives in :math:`x` and
+            :math:`y`.
         '''
         expression = self.get_symbolic_frequency_perturbation_z()[0]
         x,y = sp.symbols('x y', real = True)
@@ -329,143 +1074,242 @@ class Time_Delay_Network():
         expression2 = expression.subs(D)
         num_real,num_imag = expression2.expand().as_real_imag()
 
-        diff_x_real = num_real.diff(x)
-        diff_y_imag = num_real.diff(y)
+        diff_x = 2*(num_real*num_real.diff(x) + num_imag*num_imag.diff(x))
+        diff_y = 2*(num_real*num_real.diff(y) + num_imag*num_imag.diff(y))
 
-        func =  ufuncify( [x,y]+self.Ts, num_real**2 + num_imag**2)
-        dfunc_x =  ufuncify( [x,y]+self.Ts,num_real*diff_x_real)
-        dfunc_y =  ufuncify( [x,y]+self.Ts, num_imag*diff_y_imag)
+        if use_ufuncify:
+            make_func = lambda expr: ufuncify( [x,y]+self.Ts, expr)
+        else:
+            make_func = lambda expr: sp.lambdify( [x,y]+self.Ts, expr, 'numpy')
+        func = make_func(num_real**2 + num_imag**2)
+        dfunc_x = make_func(diff_x)
+        dfunc_y = make_func(diff_y)
 
         return func, lambda x,y,*Ts: np.asarray([dfunc_x(x,y,*Ts),dfunc_y(x,y,*Ts)])
 
-    def _find_instances_in_range_good_initial_point(self,z,freq_range,T):
+    def _find_instances_in_range(self,zs,freq_range,T):
         '''
         Find numbers of the form :math:`z + Tni` where :math:`T` is the
-        period and :math:`n` is an integer inside the given frequency range.
-        Assumes the given z is in the desired frequency range.
+        period and :math:`n` is an integer inside the given frequency range,
+        for all the given z at once.
 
         Args:
-            z (complex number).
+            zs (array of complex numbers).
 
             freq_range (2-tuple): (minimum frequency, maximum frequency).
 
+            T (float): the period.
+
         Returns:
-            (list of complex numbers):
-            list of numbers of the desired form.
+            (tuple of two arrays):
+            The numbers of the desired form, grouped by the element of zs
+            they come from and ordered by frequency, and an integer array
+            with the index in zs each number comes from.
         '''
-        lst_in_range = [z]
-        num_below = int((z.imag - freq_range[0])/T )
-        num_above = int((freq_range[1] - z.imag)/T )
-        above_range = (np.asarray(range(num_above))+1) * T
-        below_range = (np.asarray(range(num_below))+1) * T
-        lst_in_range += [z + 1j * disp for disp in above_range]
-        lst_in_range += [z - 1j * disp for disp in below_range]
-        return lst_in_range
-
-    def _find_instances_in_range(self,z,freq_range,T):
-        '''
-        Find numbers of the form :math:`z + Tni` where :math:`T` is the
-        period and :math:`n` is an integer inside the given frequency range.
+        zs = np.asarray(zs)
+        n_min = np.ceil((freq_range[0] - zs.imag) / T).astype(int)
+        n_max = np.floor((freq_range[1] - zs.imag) / T).astype(int)
+        counts = np.maximum(n_max - n_min + 1, 0)
+        indices = np.repeat(np.arange(len(zs)),counts)
+        starts = np.repeat(np.cumsum(counts) - counts,counts)
+        ns = np.repeat(n_min,counts) + np.arange(counts.sum()) - starts
+        return zs[indices] + 1j*T*ns, indices
+
+    def _make_commensurate_base_roots(self,use_sympy = False):
+        r'''
+        Find the roots of the polynomial describing the poles for
+        commensurate delays. Each of these roots generates a chain of poles
+        spaced by the period :math:`2 \pi / T_{gcd}` along the imaginary
+        axis. Sets self.commensurate_roots.
 
         Args:
-            z (complex number).
-
-            freq_range (2-tuple): (minimum frequency, maximum frequency).
+            use_sympy (optional [boolean]): find the polynomial describing
+                the roots symbolically with sympy, instead of numerically
+                (see _make_T_denom_poly_coeffs).
 
         Returns:
-            (list of complex numbers):
-            list of numbers of the desired form. Empty list if none exist.
+            The period of the poles (float).
         '''
-        if z.imag >= freq_range[0] and z.imag <= freq_range[1]:
-            return self._find_instances_in_range_good_initial_point(z,freq_range,T)
-        elif z.imag > freq_range[1]:
-            min_dist = (int((z.imag - freq_range[1])/T)+1) * T
-            max_dist = int((z.imag - freq_range[0]) / T) * T
-            if min_dist > max_dist:
-                return []
-            else:
-                return self._find_instances_in_range_good_initial_point(
-                    z - 1j*min_dist,freq_range,T)
+        if use_sympy:
+            self._make_T_denom_sym()
+            poly = sp.Poly(self.T_denom_sym, self.x)
+            poly_coeffs = poly.all_coeffs()
         else:
-            min_dist = (int((freq_range[0] - z.imag)/T)+1) * T
-            max_dist = int((freq_range[1] - z.imag)/T)  * T
-            if min_dist > max_dist:
-                return []
-            else:
-                return self._find_instances_in_range_good_initial_point(
-                    z + 1j*min_dist,freq_range,T)
+            poly_coeffs = self._make_T_denom_poly_coeffs()
+        roots = np.roots(poly_coeffs)
+        roots = roots[roots != 0]  ## zero roots correspond to no poles
+        self.commensurate_roots = np.log(roots) / float(self.Decimal_gcd)
+        return 2.*np.pi / float(self.Decimal_gcd)
 
-    def make_commensurate_roots(self,list_of_ranges = []):
+    def make_commensurate_roots(self,list_of_ranges = [],use_sympy = False):
         '''
         Assuming the delays are commensurate, obtain all the roots within the
-        frequency ranges of interest. Sets self.roots a list of complex roots
-        in the desired frequency ranges.
+        frequency ranges of interest. Sets self.roots a list of complex
+        roots in the desired frequency ranges, as the other root-finding
+        methods do, and
+        self.map_root_to_commensurate_index an integer array with the index
+        in self.commensurate_roots of the root generating each of them.
 
         Args:
             list_of_ranges (optional [list of 2-tuples]): list of frequency
                 ranges of interest in the form:
                 (minimum frequency, maximum frequency).
 
+            use_sympy (optional [boolean]): find the polynomial describing
+                the roots symbolically with sympy, instead of numerically
+                (see _make_T_denom_poly_coeffs).
+
         Returns:
             None.
         '''
+        T_gcd = self._make_commensurate_base_roots(use_sympy)
 
-        self._make_T_denom_sym()
+        roots = [np.zeros(0,dtype='complex_')]
+        indices = [np.zeros(0,dtype=int)]
+        for freq_range in list_of_ranges:
+            new_roots,new_indices = self._find_instances_in_range(
+                self.commensurate_roots,freq_range,T_gcd)
+            roots.append(new_roots)
+            indices.append(new_indices)
+        self.roots = np.concatenate(roots).tolist()
+        self.pole_set = None
+        self.map_root_to_commensurate_index = np.concatenate(indices)
+        return
 
-        poly = sp.Poly(self.T_denom_sym, self.x)
-        poly_coeffs = poly.all_coeffs()
-        roots = np.roots(poly_coeffs)
-        zs = np.asarray(map(lambda r: np.log(r) / float(self.Decimal_gcd),
-                        roots))
+    def iter_commensurate_roots(self,freq_range,band_width,use_sympy = False):
+        '''
+        Assuming the delays are commensurate, lazily generate the roots
+        within a frequency range, one frequency band at a time. This avoids
+        holding all the roots in memory for very wide frequency ranges.
+
+        Args:
+            freq_range (2-tuple): (minimum frequency, maximum frequency).
 
-        T_gcd = 2.*np.pi / float(self.Decimal_gcd)
+            band_width (float): width of each frequency band.
 
-        self.map_root_to_commensurate_index = {}
-        lst_to_return = []
-        for freq_range in list_of_ranges:
-            for i,r in enumerate(zs):
-                prev_len = len(lst_to_return)
-                new_roots = self._find_instances_in_range(r,freq_range,T_gcd)
-                len_new_roots = len(new_roots)
-                lst_to_return += new_roots
-                for j in range(prev_len,prev_len + len_new_roots):
-                    self.map_root_to_commensurate_index[j] = i
-        self.roots = lst_to_return
-        self.commensurate_roots = zs
-        return
+            use_sympy (optional [boolean]): find the polynomial describing
+                the roots symbolically with sympy, instead of numerically.
+
+        Returns:
+            (iterator of tuples of two arrays):
+            The roots in each band and an integer array with the index
+            in self.commensurate_roots of the root generating each of them.
+
+        Raises:
+            Exception: band_width must be positive.
+        '''
+        if not band_width > 0:
+            raise Exception("band_width must be positive.")
+        return self._iter_commensurate_bands(freq_range,band_width,use_sympy)
+
+    def _iter_commensurate_bands(self,freq_range,band_width,use_sympy):
+        '''Generator for iter_commensurate_roots.
+        '''
+        T_gcd = self._make_commensurate_base_roots(use_sympy)
+        lower = freq_range[0]
+        while True:
+            upper = min(lower + band_width,freq_range[1])
+            roots,indices = self._find_instances_in_range(
+                self.commensurate_roots,(lower,upper),T_gcd)
+            if upper < freq_range[1]:
+                in_band = roots.imag < upper
+                roots,indices = roots[in_band],indices[in_band]
+            yield roots,indices
+            if upper >= freq_range[1]:
+                break
+            lower = upper
 
     def make_commensurate_vecs(self,):
+        '''
+        Generate the vectors of the Potapov factors for commensurate roots.
+        The vectors are only computed for the roots in
+        self.commensurate_roots, since the periodic copies of each root share
+        the same vector. Sets self.pole_set, a Potapov.Periodic_Poles
+        grouping self.roots into chains of consecutive copies, and self.vecs,
+        which refers to the shared vector of each root.
+
+        '''
         self.commensurate_vecs = Potapov.get_Potapov_vecs(
             self.T,self.commensurate_roots)
-        self.vecs = map(
-            lambda i: self.commensurate_vecs[self.map_root_to_commensurate_index[i]],
-            range(len(self.roots)) )
+        period = 2.*np.pi / float(self.Decimal_gcd)
+        roots = np.asarray(self.roots)
+        indices = np.asarray(self.map_root_to_commensurate_index,dtype=int)
+        ns = np.round((roots.imag - self.commensurate_roots[indices].imag)
+            / period).astype(int)
+        new_chain = np.ones(len(roots),dtype=bool)
+        new_chain[1:] = (indices[1:] != indices[:-1]) | (ns[1:] != ns[:-1]+1)
+        starts = np.flatnonzero(new_chain)
+        ends = np.r_[starts[1:],len(roots)] - 1
+        self.pole_set = Potapov.Periodic_Poles(self.commensurate_roots,period,
+            np.c_[indices[starts],ns[starts],ns[ends]],self.commensurate_vecs)
+        self.vecs = [self.commensurate_vecs[i] for i in indices]
         return
 
+    def get_pole_sensitivities(self,roots = None):
+        '''Get the first-order sensitivities of the poles to the delays and
+        to the entries of M1 (see functions.delay_det_sensitivities).
+
+        The first columns, for the delays, can be passed to
+        Hamiltonian.perturb_roots_z to predict the effect of Delta_delays.
+
+        Args:
+            roots (optional [list of complex numbers]): the poles. By default
+                self.roots.
+
+        Returns:
+            An array of shape (number of poles, n + n**2) for n delays, with
+            the derivatives by the delays followed by the derivatives by the
+            entries of M1 in row-major order.
+        '''
+        if roots is None:
+            roots = self.roots
+        return delay_det_sensitivities(np.asarray(roots,dtype='complex_'),
+            self.M1,self.delays)
+
     def make_T_Testing(self):
         '''Generate the approximating transfer function using the identified
         poles of the transfer function.
 
         '''
-        self.T_testing = Potapov.get_Potapov(self.T,self.roots,self.vecs)
+        if self.pole_set is not None:
+            self.T_testing = Potapov.get_Potapov_periodic(self.T,self.pole_set)
+        else:
+            self.T_testing = Potapov.get_Potapov(self.T,self.roots,self.vecs)
         return
 
-    def make_vecs(self):
+    def make_vecs(self,symmetric = False):
         '''Generate an ordered list of vectors representing the form of the
         Potapov factors.
 
+        Args:
+            symmetric (optional [boolean]): for a network with real M1 and
+                delays, use the conjugate of the residue at a pole's mirror
+                image when it is also a pole (see _get_residues).
+
         '''
-        self.vecs = Potapov.get_Potapov_vecs(self.T,self.roots)
+        self.pole_set = None
+        residues = self._get_residues(self.roots) if symmetric else None
+        self.vecs = Potapov.get_Potapov_vecs(self.T,self.roots,residues)
         return
 
     def make_spatial_modes(self,):
-        '''Generate the spatial modes of the network.
+        '''Generate the spatial modes of the network. When self.pole_set is
+        set, the modes are only computed once per chain, since the periodic
+        copies of a root have the same mode.
 
         '''
-        self.spatial_modes = spatial_modes(self.roots,self.M1,self.E,delays=self.delays)
+        if self.pole_set is not None:
+            chain_modes = spatial_modes(self.pole_set.base_poles,self.M1,
+                self.E,delays=self.delays)
+            self.spatial_modes = [chain_modes[i]
+                for i in self.pole_set.chain_index()]
+        else:
+            self.spatial_modes = spatial_modes(self.roots,self.M1,self.E,
+                delays=self.delays)
         return
 
-    def run_Potapov(self, commensurate_roots = False, filtering_roots = True):
+    def run_Potapov(self, commensurate_roots = False, filtering_roots = True,
+        root_method = 'contour', **kwargs):
         '''Run the entire Potapov procedure to find all important information.
         The generated roots, vecs, approximated transfer function T_Testing,
         and the spatial_modes are all stored in the class.
@@ -478,6 +1322,12 @@ class Time_Delay_Network():
                 transfer function all have negative real part. Drops ones that
                 might not.
 
+            root_method (optional[string]): the method passed to make_roots
+                if commensurate_roots is False.
+
+            kwargs: passed to make_roots, e.g. checkpoint for the 'grid'
+                method. If symmetric is True, it is also used by make_vecs.
+
         Returns:
             None.
         '''
@@ -485,13 +1335,16 @@ class Time_Delay_Network():
         if commensurate_roots:
             self.make_commensurate_roots([(-self.max_freq,self.max_freq)])
             if filtering_roots:
-                self.roots =  [r for r in self.roots if r.real <= 0]
+                keep = np.asarray(self.roots).real <= 0
+                self.roots = np.asarray(self.roots)[keep].tolist()
+                self.map_root_to_commensurate_index = (
+                    self.map_root_to_commensurate_index[keep])
             self.make_commensurate_vecs()
         else:
-            self.make_roots()
+            self.make_roots(root_method,**kwargs)
             if filtering_roots:
                 self.roots =  [r for r in self.roots if r.real <= 0]
-            self.make_vecs()
+            self.make_vecs(symmetric = kwargs.get('symmetric',False))
         self.make_T_Testing()
         self.make_spatial_modes()
         return
@@ -527,7 +1380,11 @@ class Time_Delay_Network():
                 A,B,C,D matrices.
 
         '''
-        A,B,C,D = Potapov.get_Potapov_ABCD(self.roots,self.vecs,self.T,z=z)
+        if self.pole_set is not None:
+            A,B,C,D = Potapov.get_Potapov_ABCD_periodic(self.pole_set,
+                self.T,z=z)
+        else:
+            A,B,C,D = Potapov.get_Potapov_ABCD(self.roots,self.vecs,self.T,z=z)
         if not doubled:
             return A,B,C,D
         else:
@@ -535,6 +1392,79 @@ class Time_Delay_Network():
             B_d = -double_up(C.H)
             return A_d,B_d,C_d,D_d
 
+    def _check_channel_delays(self,delays,z=0.3+1j):
+        '''Check that E(z) is diag(exp(-z*delays)) at a test point, with one
+        nonnegative delay for each internal node.
+        '''
+        N = np.asarray(self.M1).shape[0]
+        if len(delays) != N:
+            raise Exception('There are ' + str(len(delays)) + ' delays for '
+                + str(N) + ' internal nodes; set channel_delays.')
+        if min(delays) < 0:
+            raise Exception('The Pade approximation of a negative delay '
+                + 'is not stable.')
+        E = np.asarray(self.E(z),dtype='complex_').reshape(N,N)
+        if not np.allclose(E,np.diag(np.exp(-z*np.asarray(delays))),
+                           rtol=1e-12,atol=1e-12):
+            raise Exception('E(z) is not diag(exp(-z*delays)); set '
+                + 'channel_delays.')
+
+    def get_Pade_ABCD(self,n,delays=None):
+        r'''
+        Find sparse ABCD matrices of the network with each delay replaced by
+        a state-space realization of its Pade approximation (see
+        functions.pade_state_space).
+
+        With the realizations of all the delays stacked into
+        :math:`(A_d,B_d,C_d,D_d)` and :math:`K = (I - M_1 D_d)^{-1}`,
+
+        .. math::
+            A = A_d + B_d K M_1 C_d, \quad B = B_d K M_2, \\
+            C = M_3 (C_d + D_d K M_1 C_d), \quad D = M_3 D_d K M_2 + M_4,
+
+        so that :math:`C (zI - A)^{-1} B + D` approximates T(z). Uses
+        M1, M2, M3 and M4.
+
+        Args:
+            n (integer or list of integers): the total order of the Pade
+                approximation, split among the delays with
+                split_pade_order, or the order for each delay.
+
+            delays (optional [list of floats]): the delay of each internal
+                node in E(z). By default self.channel_delays, or self.delays
+                if it is None.
+
+        Return:
+            (tuple of sparse matrices):
+                A,B,C,D matrices.
+
+        Raises:
+            Exception: There must be one nonnegative delay for each
+            internal node, and E(z) must be diag(exp(-z*delays)).
+
+        '''
+        if delays is None:
+            delays = (self.delays if self.channel_delays is None
+                      else self.channel_delays)
+        self._check_channel_delays(delays)
+        if type(n) in [list,tuple]:
+            ns = n
+        else:
+            ns = split_pade_order(delays,n)
+        blocks = zip(*[pade_state_space(tau,k) for tau,k in zip(delays,ns)])
+        A_d,B_d,C_d,D_d = [sparse.block_diag(block,format='csr')
+                           for block in blocks]
+        M1,M2,M3,M4 = [sparse.csr_matrix(M)
+                       for M in (self.M1,self.M2,self.M3,self.M4)]
+        N = M1.shape[0]
+        K = sparse.csr_matrix(la.inv(np.eye(N) - (M1*D_d).toarray()))
+        KM1C = K*M1*C_d
+        A = A_d + B_d*KM1C
+        B = B_d*K*M2
+        C = M3*(C_d + D_d*KM1C)
+        D = M3*D_d*K*M2 + M4
+        return A,B,C,D
+
 class Example1(Time_Delay_Network):
     '''
     Single input, single output with a single delay.
@@ -547,6 +1477,10 @@ class Example1(Time_Delay_Network):
         self.delays = [tau]
         self.r = r
         self.M1=np.matrix([[r]])
+        t = np.sqrt(1-r**2)
+        self.M2 = np.matrix([[t]])
+        self.M3 = np.matrix([[t]])
+        self.M4 = np.matrix([[-r]])
         self.E = lambda z: np.exp(-z*self.tau)
         self.T = lambda z: np.matrix([(np.exp(-z*self.tau) - self.r)/
                                         (1.-self.r* np.exp(-z*self.tau))])
@@ -565,7 +1499,12 @@ class Example2(Time_Delay_Network):
         e = lambda z: np.exp(-z*tau)
         dim = 2
 
+        self.channel_delays = [tau,tau]
         self.M1 = np.matrix([[0,r],[r,0]])
+        t = np.sqrt(1-r**2)
+        self.M2 = np.matrix([[0,t],[t,0]])
+        self.M3 = np.matrix([[t,0],[0,t]])
+        self.M4 = np.matrix([[-r,0],[0,-r]])
         self.E = lambda z: np.matrix([[e(z),0],[0,e(z)]])
 
         self.T_denom = lambda z: (1.-r**2* e(z)**2)
@@ -612,6 +1551,9 @@ class Example3(Time_Delay_Network):
 
         M4 = np.matrix([[r1,0],
                         [0,r3]])
+        self.M2 = M2
+        self.M3 = M3
+        self.M4 = M4
 
         E = lambda z: np.matrix([[np.exp(-tau1*z),0,0,0],
                              [0,np.exp(-tau2*z),0,0],
@@ -657,6 +1599,9 @@ class Example4(Time_Delay_Network):
 
         M4 = np.matrix([[r,0],
                         [0,0]])
+        self.M2 = M2
+        self.M3 = M3
+        self.M4 = M4
 
         E = lambda z: np.matrix([[np.exp(-tau1*z),0,0,0],
                              [0,np.exp(-tau2*z),0,0],
@@ -700,6 +1645,11 @@ class Example5(Time_Delay_Network):
 
         M4 = np.matrix([[r,0],
                         [0,0]])
+        self.M2 = M2
+        self.M3 = M3
+        self.M4 = M4
+
+        self.channel_delays = [tau1+tau4,tau2-tau4,tau3,0.]
 
         E = lambda z: np.matrix([[np.exp(-(tau1+tau4)*z),0,0,0],
                              [0,np.exp(-(tau2-tau4)*z),0,0],
@@ -711,6 +1661,29 @@ class Example5(Time_Delay_Network):
         self.Tp_denom = lambda z: der(self.T_denom,z)
         self.T = lambda z: M3*E(z)*la.inv(np.eye(dim) - M1*E(z))*M2+M4
 
+def split_pade_order(taus,n):
+    '''
+    Split a total order of Pade approximation among delays, roughly in
+    proportion to their durations.
+
+    Args:
+        taus (list of floats): the delays.
+
+        n (integer): the total order.
+
+    Returns:
+        Orders (list of integers): the order for each delay, summing to n.
+    '''
+    tau_tot = sum(taus)
+    ns = [np.int(np.round(n*t)) for t in taus]
+    while (sum(ns) < n):
+        j = np.argmax([abs(t/tau_tot - float(i)/n) for t,i in zip(taus,ns)])
+        ns[j] +=1
+    while (sum(ns) > n):
+        j = np.argmax([abs(t/tau_tot - float(i)/n) for t,i in zip(taus,ns)])
+        ns[j] -=1
+    return ns
+
 def example6_pade():
     '''
     This example is the same as example 3, but we return a Pade approximation
@@ -755,22 +1728,15 @@ def example6_pade():
                     [0,r3]])
 
     def E(z,n):
-        taus = [tau1,tau2,tau3,tau4]
-        tau_tot = sum(taus)
-        ns = [np.int(np.round(n*t)) for t in taus]
-        while (sum(ns) < n):
-            j = np.argmax([abs(t/tau_tot - float(i)/n) for t,i in zip(taus,ns)])
-            ns[j] +=1
-        while (sum(ns) > n):
-            j = np.argmax([abs(t/tau_tot - float(i)/n) for t,i in zip(taus,ns)])
-            ns[j] -=1
-
+        ns = split_pade_order([tau1,tau2,tau3,tau4],n)
         return np.matrix([[Pade(ns[0],-z*tau1),0,0,0],
                          [0,Pade(ns[1],-z*tau2),0,0],
                          [0,0,Pade(ns[2],-tau3*z),0],
                          [0,0,0,Pade(ns[3],-tau4*z)]])
 
-    T = lambda z,n: M3*E(z,n)*la.inv(np.eye(dim) - M1*E(z,n))*M2+M4
+    def T(z,n):
+        E_z = E(z,n)
+        return M3*E_z*la.inv(np.eye(dim) - M1*E_z)*M2+M4
     return T
 
 def plot3D(f,points = 2000):
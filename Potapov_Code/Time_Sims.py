@@ -16,26 +16,39 @@ import Potapov
 
 def time_sim(Example, omega = 0., t1=150, dt=0.05, freq=None,
                 port_in = 0, port_out = [0,1], kind='FP',
+                pade_order = None,
              ):
     '''
     takes an example and simulates it up to t1 increments of dt.
     freq indicates the maximum frequency where we look for modes
     omega indicates the frequency of driving. omega = 0 is DC.
     port_in and port_out are where the system is driven.
+    If pade_order is given, the Pade model of that order (see
+    Time_Delay_Network.get_Pade_ABCD) is simulated instead of the Potapov
+    model, and the plot is saved as kind+'_pade' with its number of states.
     '''
     E = Example(max_freq = freq) if freq != None else Example()
-    E.run_Potapov()
-    T,T_testing,poles,vecs = E.get_outputs()
-    print "number of poles is ", len(poles)
-    num = len(poles)
-    [A,B,C,D] = Potapov.get_Potapov_ABCD(poles,vecs)
+    if pade_order is None:
+        E.run_Potapov()
+        T,T_testing,poles,vecs = E.get_outputs()
+        print "number of poles is ", len(poles)
+        num = len(poles)
+        [A,B,C,D] = Potapov.get_Potapov_ABCD(poles,vecs)
+    else:
+        A,B,C,D = E.get_Pade_ABCD(pade_order)
+        C,D = C.todense(),D.todense()
+        num = A.shape[0]
 
     y0 = np.matrix([[0]]*A.shape[1])
     t0 = 0
 
     force_func = lambda t: np.cos(omega*t)
 
-    r = ode(f).set_integrator('zvode', method='bdf')
+    if pade_order is None:
+        r = ode(f).set_integrator('zvode', method='bdf')
+    else:
+        ## the Pade model is stiff.
+        r = ode(f).set_integrator('zvode', method='bdf', nsteps=100000)
     r.set_initial_value(y0, t0).set_f_params(A,B,force_func,port_in)
 
     Y = [C*y0+D*force_func(t0)]
@@ -47,7 +60,11 @@ def time_sim(Example, omega = 0., t1=150, dt=0.05, freq=None,
         Y.append(C*r.y+D*u)
 
     time = np.linspace(t0,t1,len(Y))
-    plot_time(time,Y,port_out,port_in,num=num,kind=kind)
+    if pade_order is None:
+        plot_time(time,Y,port_out,port_in,num=num,kind=kind)
+    else:
+        plot_time(time,Y,port_out,port_in,num=num,kind=kind+'_pade',
+            unit='State')
     return
 
 
@@ -65,14 +82,15 @@ def f(t, y, A,B, force_func,forcing_port):
     u = stack_func_port(force_func,forcing_port,t,B.shape[1])
     return A*np.asmatrix(y).T+B*np.asmatrix(u)
 
-def plot_time(time,y,port_out,port_in,num=0,kind='FP',format = 'pdf'):
+def plot_time(time,y,port_out,port_in,num=0,kind='FP',format = 'pdf',
+              unit='Mode'):
     #plt.figure(1)
     plt.figure(figsize=(9,6))
     y_coords = [ [np.abs(y_el[i,port_in]) for y_el in y] for i in port_out]
     plt.xlabel('time',fontsize=24)
     plt.ylabel('Norm of Output',fontsize=24)
     plt.title('Time domain output with '+ str(num) \
-    +(' Mode' if num == 1 else ' Modes'), fontsize=28 )
+    +' '+unit+('' if num == 1 else 's'), fontsize=28 )
     [plt.plot(time,y_coords[i],label='Output port '+str(i)) for i in port_out]
     plt.tight_layout()
     plt.rcParams['legend.numpoints'] = 1
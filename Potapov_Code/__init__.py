@@ -1,6 +1,9 @@
 import Roots
 import Potapov
+import Collocation
+import AAA
 import Time_Delay_Network
+import Parameter_Sweep
 import Time_Sims
 import functions
 import tests
@@ -13,6 +13,10 @@ import numpy as np
 import numpy.linalg as la
 
 import scipy.constants as consts
+import scipy.sparse as sparse
+import scipy.sparse.linalg as sla
+import scipy.linalg
+import multiprocessing
 from fractions import gcd
 
 def gcd_lst(lst):
@@ -60,18 +64,82 @@ def limit(f,z0,N=10,eps=1e-3):
             distance from z0 at which estimating points are placed.
 
     Returns:
-        Limit value (complex):
+        Limit value (complex or matrix):
             The estimated value of :math:`limit_{z -> z_0} f(z)`.
 
     '''
-    t=np.linspace(0.,2.*np.pi*(N-1.)/N,num=N)
-    c=np.exp(1j*t)*eps
-    try:
-        s=sum(f(z0 + c_el) for c_el in c)/float(N)
-        return s
-    except:
-        print "Something went wrong in estimating the limit."
-        return
+    val = limit_batch(f,[z0],N,eps,vectorized=False)[0]
+    if np.ndim(val) == 2:
+        return np.asmatrix(val)
+    return val
+
+def _circle_values(f,points,vectorized=False):
+    '''Evaluate f at an array of points, stacking the results in an array
+    of shape points.shape + (shape of the values of f). If vectorized, f is
+    called once with the whole array, and the result is checked against a
+    call at the first point. Otherwise f is called separately for each point.
+    '''
+    if vectorized:
+        vals = np.asarray(f(points))
+        first = np.asarray(f(points.flat[0]))
+        if (vals.shape != points.shape + first.shape or
+            not np.allclose(vals[(0,)*points.ndim],first)):
+            raise Exception("f did not return its values point first.")
+        return vals
+    vals = np.asarray([np.asarray(f(z)) for z in points.ravel()])
+    return vals.reshape(points.shape + vals.shape[1:])
+
+def limit_batch(f,z0s,N=10,eps=1e-3,residue=False,richardson=False,
+    vectorized=False):
+    r'''
+    Estimate the limits of a possibly matrix-valued function f at many points
+    at once, from the mean of its values at N points on a circle of radius
+    eps around each point.
+
+    f is evaluated at all the (point, circle point) pairs in a single call
+    when it is vectorized, and separately for each pair otherwise. With N
+    points on the circle, the estimate is exact for the terms of the Taylor
+    series up to order N-1, and the error is of order :math:`eps^N`.
+
+    Args:
+        f (function): the function for which the limits will be found.
+
+        z0s (array of complex numbers): the points at which the limits are
+            evaluated.
+
+        N (optional[int]): number of points used for each estimate.
+
+        eps (optional[float]): distance from each point at which estimating
+            points are placed.
+
+        residue (optional[boolean]): estimate the limits of
+            :math:`(z - z_0) f(z)` instead, i.e. the residues of f at its
+            simple poles z0s.
+
+        richardson (optional[boolean]): also use the circles of radius eps/2
+            and cancel the error of order :math:`eps^N` by Richardson
+            extrapolation, which allows a smaller N for the same accuracy.
+
+        vectorized (optional[boolean]): whether f accepts an array of points
+            and returns an array of values of shape (shape of the points) +
+            (shape of the values of f).
+
+    Returns:
+        Limit values (array):
+            An array of shape (len(z0s),) + (shape of the values of f).
+    '''
+    z0s = np.asarray(z0s,dtype='complex_').reshape(-1)
+    c = np.exp(2j*np.pi*np.arange(N)/N)
+    radii = [eps,eps/2.] if richardson else [eps]
+    points = z0s[:,None,None] + np.outer(radii,c)[None,:,:]
+    vals = _circle_values(f,points,vectorized)
+    if residue:
+        vals = vals * (points - z0s[:,None,None]).reshape(
+            points.shape + (1,)*(vals.ndim - 3))
+    means = vals.mean(axis=2)
+    if richardson:
+        return (2.**N*means[:,1] - means[:,0]) / (2.**N - 1.)
+    return means[:,0]
 
 def factorial(n):
     '''Find the factorial of n.
@@ -88,21 +156,36 @@ def factorial(n):
         end *= k
     return end
 
+_pade_coeffs = {}
+
+def _pade_coefficients(n):
+    '''The coefficients of pade_approx(n) as an array, memoized per order.
+    '''
+    if n not in _pade_coeffs:
+        ## coefficient of z^k: c_0 = 1, c_{k+1} = c_k (n-k) / ((k+1)(2n-k)).
+        coeffs = np.ones(n+1)
+        for k in xrange(n):
+            coeffs[k+1] = coeffs[k] * (n-k) / float((k+1)*(2*n-k))
+        coeffs = coeffs[::-1]
+        coeffs.flags.writeable = False
+        _pade_coeffs[n] = coeffs
+    return _pade_coeffs[n]
+
 def pade_approx(n):
     '''Numerator coefficients of symmetric Pade approximation of math:`e^z` of order n.
 
+    The coefficients are computed with the ratios of consecutive
+    coefficients rather than with factorials, and are memoized per order.
+
     Args:
         n (integer).
 
     Returns:
-        Coefficients for Pade approximation numerator. (float):
+        Coefficients for Pade approximation numerator, from the highest power
+        of z to the constant term. (list of floats):
 
     '''
-    output = [0]*(n+1)
-    for k in xrange(0,n+1):
-        output[n-k] = float(factorial(2*n-k)) * factorial(n) / \
-                      float((factorial(2*n) )* factorial(k) * factorial(n - k) )
-    return output
+    return _pade_coefficients(n).tolist()
 
 def pade_roots(n):
     '''Extract roots of Pade polynomial.
@@ -114,25 +197,22 @@ def pade_roots(n):
         Roots of Pade polynomial. (list of complex numbers) :
 
     '''
-    return np.roots(pade_approx(n))
+    return np.roots(_pade_coefficients(n))
 
 def Q(z,n):
-    r'''Numerator of Pade approximation of :math:`e^z`.
+    r'''Numerator of Pade approximation of :math:`e^z`, evaluated with
+    Horner's method.
 
     Args:
         n (integer): order of approximation.
 
-        z (complex number): point of evaluation.
+        z (complex number or array): point(s) of evaluation.
 
     Returns:
-        Value of Numerator of Pade approximation. (float):
+        Value of Numerator of Pade approximation. (float or array):
 
     '''
-    coeffs = pade_approx(n)
-    sum = 0
-    for i in xrange(0,n+1):
-        sum += coeffs[i]*pow(z,n-i)
-    return sum
+    return np.polyval(_pade_coefficients(n),z)
 
 def Pade(n,z):
     r'''Pade pproximation of :math:`e^z`
@@ -140,14 +220,103 @@ def Pade(n,z):
     Args:
         n (integer): order of approximation
 
-        z (complex number): point of evaluation.
+        z (complex number or array): point(s) of evaluation.
 
     Returns:
-        Value of Pade approximation. (float):
+        Value of Pade approximation. (float or array):
 
     '''
+    z = np.asarray(z)
     return Q(z,n)/Q(-z,n)
 
+_pade_realizations = {}
+
+def _pade_schwarz_form(n):
+    r'''Tridiagonal realization of Pade(n,-s), memoized per order.
+
+    The Pade approximants of :math:`e^{-s} = (1 - \tanh(s/2)) /
+    (1 + \tanh(s/2))` follow from the continued fraction of
+    :math:`\tanh`, which gives a realization in the variable :math:`2/s`.
+    It is turned into one in :math:`s` and reduced with orthogonal
+    transformations to the Schwarz form of an all-pass system: A is
+    tridiagonal and skew-symmetric except for
+    :math:`A_{00} = -\beta^2/2`, :math:`B = \beta e_0` and
+    :math:`C = -D B^T`. Unlike the companion form, its entries grow only like
+    :math:`n^2`.
+
+    Returns:
+        beta, off-diagonal, D (tuple).
+    '''
+    if n not in _pade_realizations:
+        k = np.arange(n-1)
+        gamma = 1. / np.sqrt((2*k+1.)*(2*k+3.))
+        A_w = np.diag(gamma,1) - np.diag(gamma,-1)
+        A_w[0,0] = -1.
+        P = la.inv(A_w)
+        ## the realization in s is 2P, 2P e_0, 2 e_0^T P, 1 + 2 P_00.
+        b = 2.*P[:,0]
+        beta = la.norm(b)
+        v = b / beta
+        v[0] -= 1.
+        H = np.eye(n)
+        if np.dot(v,v) > 0:
+            H -= 2.*np.outer(v,v) / np.dot(v,v)
+        ## H maps b to beta e_0, and the Hessenberg reduction keeps e_0.
+        A,Q = scipy.linalg.hessenberg(2.*H.dot(P).dot(H),calc_q=True)
+        sign = np.sign(H.dot(Q)[:,0].dot(b))
+        off = (A.diagonal(1) - A.diagonal(-1)) / 2.
+        _pade_realizations[n] = (sign*beta, off, (-1.)**n)
+    return _pade_realizations[n]
+
+def pade_state_space(tau,n):
+    r'''Minimal state-space realization of the Pade approximation of
+    :math:`e^{-\tau z}` of order n, i.e. of Pade(n,-tau*z).
+
+    The realization is the tridiagonal Schwarz form of the all-pass Pade
+    approximant (see _pade_schwarz_form), which stays well conditioned at
+    high orders.
+
+    Args:
+        tau (float): the delay.
+
+        n (integer): order of approximation.
+
+    Returns:
+        [A,B,C,D] (list):
+            Sparse matrices of shapes (n,n), (n,1), (1,n) and (1,1), such
+            that :math:`C (zI - A)^{-1} B + D` is the Pade approximation.
+    '''
+    if n == 0:
+        return [sparse.csr_matrix((0,0)),sparse.csr_matrix((0,1)),
+                sparse.csr_matrix((1,0)),sparse.csr_matrix(np.ones((1,1)))]
+    beta,off,D = _pade_schwarz_form(n)
+    diag = np.zeros(n)
+    diag[0] = -beta**2 / 2.
+    A = sparse.diags([diag,off,-off],[0,1,-1],shape=(n,n),format='csr') / tau
+    B = sparse.csr_matrix(([beta / np.sqrt(tau)],([0],[0])),shape=(n,1))
+    return [A,B,-D*B.T.tocsr(),sparse.csr_matrix([[D]])]
+
+def state_space_transfer_function(A,B,C,D):
+    r'''The transfer function :math:`T(z) = C (zI - A)^{-1} B + D` of a
+    state-space model, which may be given with sparse matrices.
+
+    Args:
+        A,B,C,D (matrices): the state-space model.
+
+    Returns:
+        T (matrix-valued function): the transfer function of a complex
+        number.
+    '''
+    A,B,C,D = [sparse.csc_matrix(M) for M in (A,B,C,D)]
+    I = sparse.identity(A.shape[0],format='csc')
+    B_dense = B.toarray()
+    def T(z):
+        if A.shape[0] == 0:
+            return np.asmatrix(D.toarray())
+        X = sla.spsolve(z*I - A,B_dense).reshape(B_dense.shape)
+        return np.asmatrix(C.dot(X) + D.toarray())
+    return T
+
 def double_up(M1,M2=None):
     r'''
 
@@ -183,37 +352,286 @@ def double_up(M1,M2=None):
     bottom = np.hstack([np.conj(M2),np.conj(M1)])
     return np.vstack([top,bottom])
 
+def _I_minus_M1_E(z,M1,delays,derivative=True):
+    r'''
+    Make the matrices :math:`A(z) = I - M_1 E(z)` and their derivatives
+    :math:`A'(z)` in z, where :math:`E(z)` is diagonal with entries
+    :math:`e^{-z T_k}`.
+
+    Args:
+        z (complex number or array of complex numbers): points of evaluation.
+
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats or array): The delay following each internal
+            node. An array of shape z.shape + (number of delays,) gives
+            different delays for each point.
+
+        derivative (optional [boolean]): also make :math:`A'(z)`.
+
+    Returns:
+        A, A' (arrays):
+            Stacks of matrices of shape z.shape + M1.shape. Only A if
+            derivative is False.
+    '''
+    z = np.asarray(z,dtype='complex_')
+    delays = np.asarray(delays,dtype='float_')
+    M1 = np.asarray(M1)
+    if delays.shape[-1] != M1.shape[0]:
+        raise Exception('delays must have one delay for each internal node.')
+    exps = np.exp(-z[...,None]*delays)
+    A = np.eye(M1.shape[0]) - M1*exps[...,None,:]
+    if not derivative:
+        return A
+    A_der = M1*(delays*exps)[...,None,:]
+    return A, A_der
+
+def delay_det(z,M1,delays):
+    r'''
+    Evaluate :math:`\det(I - M_1 E(z))`, the denominator of the transfer
+    function of a network, for one or many points z.
+
+    Args:
+        z (complex number or array of complex numbers): points of evaluation.
+
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats or array): The delay following each internal
+            node, or an array of shape z.shape + (number of delays,).
+
+    Returns:
+        Determinant (complex number or array of complex numbers).
+    '''
+    return la.det(_I_minus_M1_E(z,M1,delays,derivative=False))
+
+def delay_det_log_der(z,M1,delays):
+    r'''
+    Evaluate the logarithmic derivative :math:`f'/f` in z of
+    :math:`f(z) = \det(I - M_1 E(z))` for one or many points z.
+
+    By Jacobi's formula :math:`f'/f = \text{tr}(A^{-1} A')` with
+    :math:`A = I - M_1 E(z)`, so only one LU factorization is needed per
+    point. The Newton step for the roots of f is :math:`-1/(f'/f)`.
+
+    Args:
+        z (complex number or array of complex numbers): points of evaluation.
+
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats or array): The delay following each internal
+            node, or an array of shape z.shape + (number of delays,).
+
+    Returns:
+        Logarithmic derivative (complex number or array of complex numbers):
+            Infinite where :math:`A` is exactly singular.
+    '''
+    A, A_der = _I_minus_M1_E(z,M1,delays)
+    try:
+        X = la.solve(A,A_der)
+    except la.LinAlgError:
+        ## Some point is exactly a root. Solve separately for each point.
+        shape = A.shape
+        A = A.reshape((-1,)+shape[-2:])
+        A_der = A_der.reshape((-1,)+shape[-2:])
+        X = np.empty_like(A)
+        for i in xrange(len(A)):
+            try:
+                X[i] = la.solve(A[i],A_der[i])
+            except la.LinAlgError:
+                X[i] = np.inf
+        X = X.reshape(shape)
+    return np.trace(X,axis1=-2,axis2=-1)
+
+def delay_det_der(z,M1,delays):
+    r'''
+    Evaluate the derivative in z of :math:`\det(I - M_1 E(z))` for one
+    or many points z, using Jacobi's formula.
+
+    Args:
+        z (complex number or array of complex numbers): points of evaluation.
+
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats or array): The delay following each internal
+            node, or an array of shape z.shape + (number of delays,).
+
+    Where :math:`A = I - M_1 E(z)` is exactly singular, e.g. at a root,
+    the derivative is :math:`\text{tr}(\text{adj}(A) A')` instead, with the
+    adjugate found from a singular value decomposition.
+
+    Returns:
+        Derivative (complex number or array of complex numbers).
+    '''
+    A, A_der = _I_minus_M1_E(z,M1,delays)
+    try:
+        return la.det(A)*np.trace(la.solve(A,A_der),axis1=-2,axis2=-1)
+    except la.LinAlgError:
+        return np.trace(np.matmul(_adjugate(A),A_der),axis1=-2,axis2=-1)
+
+def _adjugate(A):
+    '''The adjugate of a stack of square matrices, also when singular.
+
+    With :math:`A = U S V^H`, the adjugate is
+    :math:`\det(U) \det(V^H) V \text{adj}(S) U^H`, where
+    :math:`\text{adj}(S)` is diagonal with the products of the other
+    singular values.
+    '''
+    U,s,Vh = la.svd(A)
+    n = s.shape[-1]
+    others = np.empty_like(s)
+    for i in xrange(n):
+        others[...,i] = np.prod(np.delete(s,i,axis=-1),axis=-1)
+    phase = la.det(U)*la.det(Vh)
+    return phase[...,None,None]*np.einsum('...ji,...j,...kj->...ik',
+        Vh.conj(),others,U.conj())
+
+def delay_det_sensitivities(z,M1,delays):
+    r'''
+    First-order sensitivities of roots of :math:`f(z) = \det(I - M_1 E(z))`
+    to the delays and to the entries of :math:`M_1`, for one or many roots.
+
+    At a simple root :math:`z` the matrix :math:`A = I - M_1 E(z)` has left
+    and right null vectors :math:`u, v`, taken from its SVD. By the implicit
+    function theorem, the derivative of the root with respect to a
+    parameter :math:`p` is
+    :math:`-u^\dagger (\partial_p A) v / u^\dagger (\partial_z A) v`.
+
+    Args:
+        z (complex number or array of complex numbers): the roots.
+
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats): The delay following each internal node.
+
+    Returns:
+        Sensitivities (array):
+            An array of shape z.shape + (n + n**2,) for n internal nodes.
+            The first n entries are :math:`dz/dT_k`, the others
+            :math:`dz/d(M_1)_{ij}` with (i,j) in row-major order.
+    '''
+    z = np.asarray(z,dtype='complex_')
+    M1 = np.asarray(M1)
+    delays = np.asarray(delays,dtype='float_')
+    A, A_der = _I_minus_M1_E(z,M1,delays)
+    exps = np.exp(-z[...,None]*delays)
+    U, s, Vh = la.svd(A)
+    u = U[...,:,-1]
+    v = Vh[...,-1,:].conj()
+    denom = np.einsum('...i,...ij,...j->...',u.conj(),A_der,v)
+    ## d A / d T_k = z e^{-z T_k} M1[:,k] e_k^T
+    uM1 = np.einsum('...i,ij->...j',u.conj(),M1)
+    d_delays = -uM1 * (z[...,None]*exps) * v
+    ## d A / d (M1)_ij = -e^{-z T_j} e_i e_j^T
+    d_M1 = u.conj()[...,:,None] * (exps*v)[...,None,:]
+    n = len(delays)
+    return np.concatenate([d_delays,d_M1.reshape(z.shape + (n*n,))],
+        axis=-1) / denom[...,None]
+
+def delay_det_exponential_terms(M1,delays,eps=1e-12,max_terms=2**20):
+    r'''
+    Expand :math:`\det(I - M_1 E(z))` as an exponential polynomial
+    :math:`\sum_j c_j e^{-z \tau_j}`.
+
+    Grouping the nodes by their distinct delays :math:`\tau_g`, with
+    :math:`k_g` nodes each, the determinant is a polynomial in the
+    :math:`x_g = e^{-z \tau_g}` of degree at most :math:`k_g` in each
+    :math:`x_g`. Its :math:`\prod_g (k_g+1)` coefficients are found by
+    evaluating the determinant at roots of unity and taking a discrete
+    Fourier transform, without enumerating the subsets of the nodes. The
+    cost grows with the number of these coefficients, which is :math:`2^n`
+    when all the n delays are distinct, so it is cheap for networks with
+    few distinct delays. Terms with the same exponent are combined.
+
+    Args:
+        M1 (matrix): The connectivity matrix among internal nodes.
+
+        delays (list of floats): The delay following each internal node.
+
+        eps (optional[float]): terms with coefficients smaller than this
+            are dropped.
+
+        max_terms (optional[int]): largest number of coefficients
+            :math:`\prod_g (k_g+1)` allowed.
+
+    Returns:
+        Coefficients, exponents (tuple of arrays):
+            The coefficients :math:`c_j` and the exponents :math:`\tau_j`, in
+            increasing order of the exponents.
+
+    Raises:
+        Exception: if there would be more than max_terms coefficients.
+    '''
+    M1 = np.asarray(M1)
+    delays = np.asarray(delays,dtype=float)
+    taus,group = np.unique(np.round(delays,12),return_inverse=True)
+    shape = tuple(np.bincount(group,minlength=len(taus)) + 1)
+    if np.prod(shape,dtype=float) > max_terms:
+        raise Exception('The exponential polynomial has more than max_terms '
+                       +'coefficients; the network has too many distinct '
+                       +'delays.')
+    ## x_g at all the points of the grid of roots of unity.
+    grid = np.meshgrid(*[np.exp(2j*np.pi*np.arange(k)/k) for k in shape],
+                       indexing='ij')
+    xs = np.stack([x.ravel() for x in grid],axis=-1)[:,group]
+    vals = la.det(np.eye(len(delays)) - M1*xs[:,None,:]).reshape(shape)
+    coeffs = np.fft.fftn(vals) / vals.size
+    if np.isrealobj(M1):
+        coeffs = coeffs.real
+    powers = np.meshgrid(*[np.arange(k) for k in shape],indexing='ij')
+    exps = sum(p.ravel()*tau for p,tau in zip(powers,taus))
+    terms = {}
+    for tau,coeff in zip(np.round(exps,12),coeffs.ravel()):
+        terms[tau] = terms.get(tau,0.) + coeff
+    exponents = np.asarray(sorted(terms))
+    coeffs = np.asarray([terms[tau] for tau in exponents])
+    keep = abs(coeffs) > eps
+    return coeffs[keep], exponents[keep]
+
 def spatial_modes(roots,M1,E,delays=None):
     '''
     Obtain the spetial mode profile at each node up to a constant.
     If the delays are provided, the modes will be normalized using the delays.
     Otherwise, the modes will not be normalized.
 
+    The matrices :math:`M_1 E(z)` of all the roots are stacked, and their
+    eigenvectors with eigenvalue closest to 1 are found with one stacked
+    call to la.eig.
+
     Args:
         roots (list of complex numbers): The eigenvalues of the system.
 
         M1 (matrix): The connectivity matrix among internal nodes.
 
-        E (matrix-valued function): Time-delay matrix.
+        E (matrix-valued function): Time-delay matrix. If None, E(z) is the
+            diagonal matrix with entries :math:`e^{-z T_k}` for the delays,
+            which is evaluated for all the roots at once.
 
         delays (optional[list of floats]): List of delays in the network.
 
     Returns:
         A list of spatial eigenvectors. (list of complex-valued column matrices):
     '''
-
-    spatial_vecs = []
-    for i in xrange(len(roots)):
-        evals,evecs = la.eig(M1*E(roots[i]))
-        spatial_vecs.append(evecs[:,np.argmin(abs(1.-evals))])
-    if delays == None:
-        return spatial_vecs
-    if type(delays) != list:
-        raise Exception('delays must be a list of delays.')
-
-    for mode in spatial_vecs:
-        mode /= _norm_of_mode(mode,delays)
-    return spatial_vecs
+    roots = np.asarray(roots,dtype='complex_').reshape(-1)
+    M1 = np.asarray(M1)
+    n = M1.shape[0]
+    if len(roots) == 0:
+        return []
+    if E is None:
+        if delays is None:
+            raise Exception('delays must be given if E is None.')
+        ME = M1*np.exp(-roots[:,None]*np.asarray(delays))[:,None,:]
+    else:
+        ME = np.asarray([np.asarray(M1*E(root)) for root in roots]).reshape(
+            len(roots),n,n)
+    evals,evecs = la.eig(ME)
+    index = np.argmin(abs(1.-evals),axis=1)
+    vecs = evecs[np.arange(len(roots)),:,index]
+    if delays is not None:
+        if type(delays) != list:
+            raise Exception('delays must be a list of delays.')
+        k = min(len(delays),n)
+        vecs /= np.sqrt(np.sum(abs(vecs[:,:k])**2 * delays[:k],axis=1))[:,None]
+    return [np.asmatrix(vec).T for vec in vecs]
 
 def inner_product_of_two_modes(root1,root2,v1,v2,delays,eps=1e-7,
                                 func=lambda z : z.imag):
@@ -274,54 +692,194 @@ def _norm_of_mode(mode,delays):
     '''
     return np.sqrt(inner_product_of_two_modes(0,0,mode,mode,delays))
 
-def make_normalized_inner_product_matrix(roots,modes,delays,eps=1e-12,
-                                func=lambda z : z.imag):
+def make_normalized_inner_product_matrix(roots,modes,delays,eps=1e-7,
+                                func=lambda z : z.imag,block_size=256):
     '''
     Given a list of roots and a list of vectors representing the
     electric field at each node of the corresponding nodes, compute
     the normalized matrix representing the inner products among the
     various modes.
 
+    The inner products are those of inner_product_of_two_modes, computed
+    for all pairs at once with broadcasting, one delay at a time. The matrix
+    is Hermitian, so only the blocks of rows on and above the diagonal are
+    computed, and each block is mirrored into the lower triangle. Blocks of
+    block_size rows bound the memory used.
+
     TODO: add weights for different delays to account for geometry.
 
     Args:
         roots (list of complex numbers):
             The roots of the various eigenmodes.
 
-        modes (list of column matrices):
+        modes (list of column matrices or array):
             the amplitudes of the modes at
-            various nodes.
+            various nodes, possibly as an array of shape
+            (number of modes, number of nodes).
 
         delays (list of floats):
             The duration of each delay following
             each node in the system.
 
         eps(optional[float]):
-            cutoff for two frequencies being equal.
+            cutoff for two frequencies being equal. It is used for all the
+            pairs of modes; the default 1e-7 is the cutoff that
+            inner_product_of_two_modes applies to the off-diagonal pairs.
 
         func (optional[funciton]):
             used to transform the roots. Default
             value is set to lambda z: z.imag, meaning we take the frequency
-            of each mode.
+            of each mode. It is applied to arrays, and must be real-valued
+            and odd for the matrix to be Hermitian.
+
+        block_size (optional[int]): number of rows computed at once.
 
     Returns:
         inner product matrix (complex-valued matrix):
             A matrix of normalized inner products representing the geometric
             overlap of the various given modes in the system.
     '''
+    roots,modes,delays,norms = _modes_and_norms(roots,modes,delays)
     dim = len(roots)
-    norms = [0]*dim
-    for i,(root,v) in enumerate(zip(roots,modes)):
-        norms[i] = inner_product_of_two_modes(root,root,v,v,delays,eps=eps,
-                                        func=func)
     inner_prods = np.zeros((dim,dim),dtype='complex_')
-    for i in range(dim):
-        for j in range(dim):
-            inner_prods[i,j] = ((inner_product_of_two_modes(roots[i],roots[j],
-                                modes[i],modes[j],delays)) /
-                                np.sqrt(norms[i]*norms[j]) )
+    for start in xrange(0,dim,block_size):
+        rows = slice(start,min(start+block_size,dim))
+        block = _inner_product_block(roots[rows],roots[start:],modes[rows],
+            modes[start:],delays,eps,func)
+        inner_prods[rows,start:] = block
+        inner_prods[start:,rows] = block.conj().T
+    inner_prods /= np.sqrt(norms[:,None]*norms[None,:])
     return inner_prods
 
+def _modes_and_norms(roots,modes,delays):
+    '''Arrays of the roots, of the modes of shape (number of modes, number
+    of delays) and of the delays, and the squared norms of the modes.
+    '''
+    roots = np.asarray(roots,dtype='complex_').reshape(-1)
+    modes = np.asarray(modes).reshape(len(roots),-1)
+    ## as in inner_product_of_two_modes, extra nodes or delays are ignored.
+    k = min(len(delays),modes.shape[1])
+    modes = modes[:,:k]
+    delays = np.asarray(delays,dtype=float)[:k]
+    norms = np.sum(abs(modes)**2 * delays,axis=1)
+    return roots,modes,delays,norms
+
+def _inner_product_block(roots1,roots2,modes1,modes2,delays,eps,func):
+    '''The inner products (see inner_product_of_two_modes) of all the pairs
+    of modes from two sets, as an array of shape (len(roots1),len(roots2)).
+    '''
+    diff = func(roots1[:,None] - roots2[None,:])
+    equal = abs(diff) < eps
+    diff = np.where(equal,1.,diff)
+    block = np.zeros(diff.shape,dtype='complex_')
+    for delay,col1,col2 in zip(delays,modes1.T,modes2.T):
+        weights = np.where(equal,delay,1j*np.expm1(-1j*delay*diff)/diff)
+        block += col1[:,None] * col2[None,:].conj() * weights
+    return block
+
+def _overlap_tile(args):
+    '''The normalized inner products of a tile of the overlap matrix, and
+    the indices and values of those above the threshold. Takes
+    (roots1,roots2,modes1,modes2,norms1,norms2,delays,eps,func,threshold),
+    for multiprocessing.
+    '''
+    roots1,roots2,modes1,modes2,norms1,norms2,delays,eps,func,threshold = args
+    tile = _inner_product_block(roots1,roots2,modes1,modes2,delays,eps,func)
+    tile /= np.sqrt(norms1[:,None]*norms2[None,:])
+    i,j = np.nonzero(abs(tile) >= threshold)
+    return tile, i, j, tile[i,j]
+
+def make_sparse_inner_product_matrix(roots,modes,delays,threshold=1e-3,
+                                     tile_size=1024,filename=None,processes=1,
+                                     eps=1e-7,func=np.imag):
+    '''
+    Compute the normalized inner product matrix of
+    make_normalized_inner_product_matrix in square tiles, keeping only the
+    entries with magnitude at least threshold. The dense matrix is never
+    held in memory, so that the overlaps of many modes can be studied.
+
+    Only the tiles on and above the diagonal are computed, and the others
+    are found from the matrix being Hermitian.
+
+    Args:
+        roots (list of complex numbers):
+            The roots of the various eigenmodes.
+
+        modes (list of column matrices or array):
+            the amplitudes of the modes at various nodes.
+
+        delays (list of floats):
+            The duration of each delay following each node in the system.
+
+        threshold (optional[float]):
+            smallest magnitude of the entries kept.
+
+        tile_size (optional[int]):
+            number of rows and columns of each tile.
+
+        filename (optional[str]):
+            if given, all the entries are also written to a memory-mapped
+            file with this name, which can be opened with
+            np.memmap(filename,dtype='complex_',shape=(M,M)) for M modes.
+
+        processes (optional[int]):
+            number of processes used to compute the tiles. func must then be
+            picklable, e.g. a module-level function.
+
+        eps(optional[float]):
+            cutoff for two frequencies being equal.
+
+        func (optional[funciton]):
+            used to transform the roots, applied to arrays. By default the
+            imaginary part, as for make_normalized_inner_product_matrix.
+
+    Returns:
+        inner product matrix (scipy.sparse.csr_matrix):
+            The entries of the normalized inner product matrix with magnitude
+            at least threshold. Empty of shape (0,0) if there are no modes,
+            in which case the file is empty too.
+    '''
+    if len(roots) == 0:
+        if filename is not None:
+            open(filename,'wb').close()
+        return sparse.csr_matrix((0,0),dtype='complex_')
+    roots,modes,delays,norms = _modes_and_norms(roots,modes,delays)
+    dim = len(roots)
+    starts = range(0,dim,tile_size)
+    tiles = [(slice(a,min(a+tile_size,dim)),slice(b,min(b+tile_size,dim)))
+             for a in starts for b in starts if a <= b]
+    args = ((roots[r],roots[c],modes[r],modes[c],norms[r],norms[c],
+             delays,eps,func,threshold) for r,c in tiles)
+    if filename is not None:
+        dense = np.memmap(filename,dtype='complex_',mode='w+',shape=(dim,dim))
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    rows,cols,data = [],[],[]
+    try:
+        results = pool.imap(_overlap_tile,args) if pool else (
+            _overlap_tile(arg) for arg in args)
+        for (r,c),(tile,i,j,vals) in zip(tiles,results):
+            rows.append(i + r.start)
+            cols.append(j + c.start)
+            data.append(vals)
+            if filename is not None:
+                dense[r,c] = tile
+            if r.start != c.start:
+                rows.append(j + c.start)
+                cols.append(i + r.start)
+                data.append(vals.conj())
+                if filename is not None:
+                    dense[c,r] = tile.conj().T
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    if filename is not None:
+        dense.flush()
+        del dense
+    return sparse.coo_matrix((np.concatenate(data),
+        (np.concatenate(rows),np.concatenate(cols))),
+        shape=(dim,dim)).tocsr()
+
 def make_nonlinear_interaction(natural_freqs, modes, delays, delay_indices,
                                 start_nonlin,length_nonlin,plus_or_minus_arr,
                                 indices_of_refraction = None,
@@ -444,3 +1002,98 @@ def make_nonlinear_interaction(natural_freqs, modes, delays, delay_indices,
         return const * length_nonlin
     else:
         return 1j*const*(np.exp(-1j*delta_k*length_nonlin) - 1 ) / delta_k
+
+def make_nonlinear_interaction_batch(natural_freqs, modes, delays,
+                                     delay_indices, start_nonlin,
+                                     length_nonlin, combinations,
+                                     plus_or_minus_arrs,
+                                     indices_of_refraction = None,
+                                     eps=1e-12):
+    '''
+    Compute the nonlinear interactions of make_nonlinear_interaction for many
+    combinations of modes and of creation/annihilation operators at once.
+
+    Row r of the result is make_nonlinear_interaction for the modes
+    combinations[r] with the signs plus_or_minus_arrs[r].
+
+    Args:
+        natural_freqs (list of complex numbers):
+            The natural frequencies of all the eigenmodes.
+
+        modes (list of column matrices):
+            the amplitudes of all the modes at
+            various nodes.
+
+        delays (list of floats):
+            The duration of each delay following
+            each node in the system.
+
+        delay_indices (int OR list/tuple of ints):
+            the index of the delay
+            line along which the nonlinearity lies, for each position in the
+            combinations.
+
+        start_nonlin (float OR list/tuple of floats):
+            the beginning of the
+            nonlinearity along each delay line.
+
+        length_nonlin (float):
+            duration of the nonlinearity in terms of length.
+
+        combinations (array of ints):
+            Array of shape (number of
+            combinations, k) with the indices of the modes in each combination.
+
+        plus_or_minus_arrs (array of 1s and -1s):
+            Array of the same shape
+            as combinations, with the creation/annihilation of a photon in each
+            mode of the combination.
+
+        indices_of_refraction (optional[float or array]):
+            the indices of
+            refraction for each mode in each combination, as an array of the
+            same shape as combinations. If a float then all are the same.
+
+        eps(optional[float]):
+            cutoff for the phase-mismatch being zero.
+
+    Returns:
+        nonlinear interactions (array of complex numbers):
+            strength of nonlinearity for each combination.
+    '''
+    combinations = np.asarray(combinations,dtype=int)
+    if combinations.ndim != 2:
+        raise Exception('combinations must be a two-dimensional array.')
+    K,k = combinations.shape
+    signs = np.asarray(plus_or_minus_arrs)
+    if signs.shape != (K,k):
+        raise Exception('plus_or_minus_arrs must have the same shape as '
+                       +'combinations.')
+    if not np.all((signs == 1) | (signs == -1)):
+        raise Exception('bad input value -- must be 1 or -1.')
+    delay_indices = np.broadcast_to(np.asarray(delay_indices,dtype=int),(k,))
+    start_nonlin = np.broadcast_to(np.asarray(start_nonlin,dtype=float),(k,))
+    if length_nonlin < 0:
+        raise Exception('length_nonlin must be greater than 0.')
+    if np.any(start_nonlin < 0):
+        raise Exception('each element of start_nonlin must be greater than 0.')
+    if np.any(length_nonlin / consts.c + start_nonlin
+              > np.asarray(delays)[delay_indices]):
+        raise Exception('length_nonlin + start_loc must be less than the '
+                       +'delay of index delay_index for start_loc in '
+                       +'start_nonlin and delay_index in delay_indices.')
+    if indices_of_refraction is None:
+        indices_of_refraction = 1.
+    freqs = np.asarray(natural_freqs)[combinations]
+    values_at_nodes = np.asarray(modes).reshape(len(modes),-1)[
+        combinations,delay_indices]
+
+    delta_k = ( np.sum(indices_of_refraction*freqs*signs,axis=1)
+        / consts.speed_of_light )
+    factors = values_at_nodes*np.exp(-1j*delta_k[:,None]*start_nonlin)
+    const = np.prod(np.where(signs == 1,factors,np.conj(factors)),axis=1)
+
+    matched = abs(delta_k) < eps ## delta_k \approx 0
+    delta_k = np.where(matched,1.,delta_k)
+    return np.where(matched, const * length_nonlin,
+        1j*const*np.expm1(-1j*delta_k*length_nonlin) / delta_k)
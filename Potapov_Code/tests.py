@@ -4,8 +4,11 @@ import Time_Delay_Network
 import functions
 import numpy as np
 import numpy.testing as testing
+import Time_Sims
 import Time_Sims_nonlin
 import Hamiltonian
+import AAA
+import Parameter_Sweep
 
 import numpy as np
 import numpy.linalg as la
@@ -14,6 +17,9 @@ import scipy.constants as consts
 
 import matplotlib.pyplot as plt
 import time
+import os
+import tempfile
+import shutil
 
 
 def test_altered_delay_pert(plot=False,eps=1e-5):
@@ -80,6 +86,754 @@ def test_altered_delay_pert(plot=False,eps=1e-5):
 
     ## TODO: make a function to perturb in several steps to avoid root-skipping.
 
+def test_lambdify_pertub_func(eps=1e-9):
+    '''
+    The vectorized perturbation function generated with lambdify should
+    agree with the one obtained by substituting numbers into the symbolic
+    expression, for arrays of roots with different delays for each root.
+    '''
+    Ex = Time_Delay_Network.Example3()
+    func_subs = Ex.get_frequency_pertub_func_z(use_ufuncify = False)
+    func_vec = Ex.get_frequency_pertub_func_z(use_lambdify = True)
+    zs = np.asarray([-0.5+3j, -1.+10j, -0.2-7j])
+    Ts = np.asarray(Ex.delays) + 1e-3*np.arange(3)[:,None]
+    perts = func_vec(zs,Ts)
+    assert perts.shape == (3,)
+    for z,T,pert in zip(zs,Ts,perts):
+        assert abs(func_subs(z,T) - pert) < eps
+
+def test_perturb_roots_z_vectorized(eps=1e-9):
+    '''
+    Perturbing all the roots at once with a vectorized Newton's method
+    function should give the same roots as perturbing them one at a time.
+    '''
+    Ex = Time_Delay_Network.Example1(max_freq = 100.)
+    Ex.run_Potapov()
+    perturb_func = Ex.get_frequency_pertub_func_z(use_lambdify = True)
+
+    hams = []
+    for vectorized in [False,True]:
+        ham = Hamiltonian.Hamiltonian(list(Ex.roots),Ex.spatial_modes,Ex.delays,
+                    Omega=np.eye(len(Ex.roots)))
+        chi_nonlin_test = Hamiltonian.Chi_nonlin(delay_indices=[0],
+                    start_nonlin=0,length_nonlin=0.1*consts.c)
+        chi_nonlin_test.refraction_index_func = lambda freq, pol: (
+            1. + abs(freq / (5000*np.pi)) )
+        ham.chi_nonlinearities.append(chi_nonlin_test)
+        converged,counts = ham.perturb_roots_z(perturb_func,
+                    vectorized=vectorized)
+        assert converged.all()
+        hams.append(ham)
+    assert np.amax(abs(np.asarray(hams[0].roots) - hams[1].roots)) < eps
+
+def test_minimize_roots_z_batched(eps=1e-3):
+    '''
+    The batched Gauss-Newton minimization should find the same roots as
+    minimizing separately for each root with scipy.
+    '''
+    Ex = Time_Delay_Network.Example1(max_freq = 100.)
+    Ex.run_Potapov()
+    func,dfunc = Ex.get_minimizing_function_z(use_ufuncify = False)
+
+    hams = []
+    for batched in [False,True]:
+        ham = Hamiltonian.Hamiltonian(list(Ex.roots),Ex.spatial_modes,Ex.delays,
+                    Omega=np.eye(len(Ex.roots)))
+        ham.make_chi_nonlinearity(delay_indices=[0],start_nonlin=0,
+                    length_nonlin=0.1*consts.c,
+                    refraction_index_func = lambda freq, pol: (
+                        1. + abs(freq / (5000*np.pi)) ))
+        ham.minimize_roots_z(func,dfunc,batched=batched)
+        hams.append(ham)
+    roots = np.asarray(hams[1].roots)
+    Ts = np.asarray(Ex.delays) + hams[1].Delta_delays
+    assert np.amax(func(roots.real,roots.imag,*Ts.T)) < 1e-20
+    assert np.amax(abs(np.asarray(hams[0].roots) - roots)) < eps
+
+def test_numeric_pertub_func(eps=1e-9):
+    '''
+    The numeric Newton's method function uses Jacobi's formula for the
+    derivative of the determinant. Compare against finite differences of
+    T_denom, and check that Newton's method converges to the same roots as
+    with the symbolic function.
+    '''
+    Ex = Time_Delay_Network.Example3()
+    zs = np.asarray([-0.5+3j, -1.+10j, -0.2-7j])
+    h = 1e-6
+    dets = functions.delay_det(zs,Ex.M1,Ex.delays)
+    fd = np.asarray([(Ex.T_denom(z+h) - Ex.T_denom(z-h)) / (2*h) for z in zs])
+    assert np.amax(abs(dets - [Ex.T_denom(z) for z in zs])) < eps
+    assert np.amax(abs(fd/dets
+        - functions.delay_det_log_der(zs,Ex.M1,Ex.delays))) < 1e-6
+    assert np.amax(abs(fd
+        - functions.delay_det_der(zs,Ex.M1,Ex.delays))) < 1e-6
+    ## I - M1 E(0) is exactly singular here, and det' = T_1 / 2 at z = 0.
+    M1,delays = np.diag([1.,0.5]),[0.3,0.7]
+    points = np.asarray([0.,-0.5+3j])
+    f = lambda z: functions.delay_det(z,M1,delays)
+    ders = functions.delay_det_der(points,M1,delays)
+    assert abs(ders[0] - 0.15) < eps
+    assert abs(ders[1] - (f(points[1]+h) - f(points[1]-h)) / (2*h)) < 1e-6
+
+    func_sym = Ex.get_frequency_pertub_func_z(use_lambdify = True)
+    func_num = Ex.get_numeric_frequency_pertub_func_z()
+    roots = zs.copy()
+    for i in range(20):
+        roots += func_num(roots,[Ex.delays]*3)
+    Ts = np.asarray(Ex.delays) + 1e-3*np.arange(3)[:,None]
+    roots_sym = roots.copy(); roots_num = roots.copy()
+    for i in range(20):
+        roots_sym += func_sym(roots_sym,Ts)
+        roots_num += func_num(roots_num,Ts)
+    assert np.amax(abs(roots_sym - roots_num)) < eps
+    assert np.amax(abs(functions.delay_det(roots_num,Ex.M1,Ts))) < eps
+
+def test_commensurate_roots_numeric_poly(eps=1e-7):
+    '''
+    The numerically generated polynomial for commensurate delays should
+    give the same roots as the symbolic one, and these should be zeros of
+    T_denom also when the polynomial has a large degree.
+    '''
+    X = Time_Delay_Network.Example3(tau1 = 0.1, tau2 = 0.2,tau3 = 0.1,tau4 = 0.2,)
+    X.make_commensurate_roots([(-100,100)],use_sympy = True)
+    roots_sym = X.roots
+    X.make_commensurate_roots([(-100,100)])
+    assert len(X.roots) == len(roots_sym)
+    for root in X.roots:
+        assert np.amin(abs(root - np.asarray(roots_sym))) < eps
+
+    X = Time_Delay_Network.Example3()  ## polynomial of degree 60
+    X.make_commensurate_roots([(-500,500)])
+    assert len(X.roots) > 0
+    assert max(abs(X.T_denom(root)) for root in X.roots) < eps
+
+def test_iter_commensurate_roots():
+    '''
+    Generating the commensurate roots band by band should give the same
+    roots as generating them all at once, and each root should differ
+    from the root generating it by a multiple of the period.
+    '''
+    X = Time_Delay_Network.Example3()
+    X.make_commensurate_roots([(-500,500)])
+    period = 2.*np.pi / float(X.Decimal_gcd)
+    assert type(X.roots) == list
+    diffs = (np.asarray(X.roots)
+             - X.commensurate_roots[X.map_root_to_commensurate_index])
+    testing.assert_allclose(diffs.real,0.,atol=1e-12)
+    testing.assert_allclose(diffs.imag / period,
+        np.round(diffs.imag / period),atol=1e-9)
+    bands = list(X.iter_commensurate_roots((-500,500),37.))
+    roots_from_bands = np.concatenate([roots for roots,indices in bands])
+    testing.assert_allclose(np.sort_complex(roots_from_bands),
+        np.sort_complex(X.roots))
+    for band_width in [0.,-37.]:
+        testing.assert_raises(Exception,X.iter_commensurate_roots,(-500,500),
+            band_width)
+
+def test_periodic_pole_set(eps=1e-9):
+    '''
+    The Potapov product and ABCD model built from the periodic pole set of
+    commensurate roots should match the ones built from all the poles.
+    '''
+    X = Time_Delay_Network.Example3(tau1 = 0.1, tau2 = 0.2,tau3 = 0.1,tau4 = 0.2,
+        max_freq = 100.)
+    X.run_Potapov(commensurate_roots = True)
+    pole_set = X.pole_set
+    assert len(pole_set) == len(X.roots)
+    testing.assert_allclose(pole_set.poles(),X.roots,atol=1e-12)
+    assert len(pole_set.vecs) == len(X.commensurate_roots)
+
+    T_testing = Potapov.get_Potapov(X.T,X.roots,X.vecs)
+    for z in [-10j,-50j,0.3-70j]:
+        testing.assert_allclose(X.T_testing(z),T_testing(z),atol=eps)
+
+    A,B,C,D = X.get_Potapov_ABCD(z=0.)
+    A_r,B_r,C_r,D_r = Potapov.get_Potapov_ABCD(X.roots,X.vecs,X.T,z=0.)
+    for M,M_r in zip((A,B,C,D),(A_r,B_r,C_r,D_r)):
+        testing.assert_allclose(M,M_r,atol=eps)
+
+    modes = functions.spatial_modes(X.roots,X.M1,X.E,delays=X.delays)
+    for mode,mode_r in zip(X.spatial_modes,modes):
+        phase = (mode_r.H*mode)[0,0] / abs((mode_r.H*mode)[0,0])
+        testing.assert_allclose(mode,mode_r*phase,atol=1e-7)
+
+    ## new roots from any engine should drop the stale periodic pole set.
+    for method in ['grid','contour']:
+        X.make_roots(method)
+        assert X.pole_set is None
+    X.make_commensurate_roots([(-50.,50.)])
+    assert X.pole_set is None
+
+
+def test_near_commensurate_roots(eps=1e-7):
+    '''
+    The roots found by approximating the delays by commensurate ones should
+    be the same as the ones found with the contour method, and their number
+    should agree with the argument principle.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 50.,max_linewidth = 2.)
+    X.make_roots()
+    roots_contour = np.asarray(X.roots)
+    X.make_roots(method = 'near_commensurate',denominator = 20)
+    roots = np.asarray(X.roots)
+    assert len(roots) == len(roots_contour)
+    for root in roots_contour:
+        assert np.amin(abs(root - roots)) < eps
+
+    X = Time_Delay_Network.Example3(max_freq = 1000.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate',verify = False)
+    count = Roots.count_roots_rect(
+        lambda z: functions.delay_det_log_der(z,X.M1,X.delays),
+        -5.,0.,5.,1000.,N=5000)
+    assert len(X.roots) == int(round(count.real))
+    assert len(Roots.purge_array(X.roots,eps)) == len(X.roots)
+    assert max(abs(X.T_denom(root)) for root in X.roots) < eps
+
+def test_asymptotic_roots(eps=1e-7):
+    '''
+    The roots predicted from the asymptotic chains and refined with Newton's
+    method should be the same as the ones found by approximating the delays
+    by commensurate ones.
+    '''
+    for X in [Time_Delay_Network.Example1(max_freq = 500.,max_linewidth = 10.),
+              Time_Delay_Network.Example3(max_freq = 500.,max_linewidth = 10.)]:
+        X.make_roots(method = 'near_commensurate')
+        roots_nc = np.asarray(X.roots)
+        X.make_roots(method = 'asymptotic',core_freq = 30.)
+        roots = np.asarray(X.roots)
+        assert len(roots) == len(roots_nc)
+        for root in roots_nc:
+            assert np.amin(abs(root - roots)) < eps
+
+def test_collocation_roots(eps=1e-7):
+    '''
+    The roots found as eigenvalues of the discretized generator of the delay
+    system should be the same as the ones found with the contour method or
+    by approximating the delays by commensurate ones.
+    '''
+    X = Time_Delay_Network.Example1(max_freq = 100.,max_linewidth = 2.)
+    X.make_roots()
+    roots_contour = np.asarray(X.roots)
+    X.make_roots(method = 'collocation')
+    roots = np.asarray(X.roots)
+    assert len(roots) == len(roots_contour)
+    for root in roots_contour:
+        assert np.amin(abs(root - roots)) < eps
+
+    X = Time_Delay_Network.Example3(max_freq = 300.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate')
+    roots_nc = np.asarray(X.roots)
+    X.make_roots(method = 'collocation',verify = False)
+    roots = np.asarray(X.roots)
+    assert len(roots) == len(roots_nc)
+    for root in roots_nc:
+        assert np.amin(abs(root - roots)) < eps
+
+def test_grid_roots(eps=1e-7):
+    '''
+    The roots found from the minima of log|T_denom| on a grid should be the
+    same as the ones found by approximating the delays by commensurate ones,
+    also when the tiles are processed in parallel.
+    '''
+    X = Time_Delay_Network.Example4(max_freq = 500.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate')
+    roots_nc = np.asarray(X.roots)
+    for processes in [1,2]:
+        X.make_roots(method = 'grid',processes = processes)
+        roots = np.asarray(X.roots)
+        assert len(roots) == len(roots_nc)
+        for root in roots_nc:
+            assert np.amin(abs(root - roots)) < eps
+
+def test_AAA_poles_and_vecs(eps=1e-8):
+    '''
+    The poles and Potapov vectors obtained from a rational fit to samples of
+    T on the imaginary axis should be the same as the ones obtained from T.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate')
+    roots = np.asarray(X.roots)
+    omegas = np.linspace(-100.,100.,2000)
+    F = np.asarray([np.asarray(X.T(1j*omega)) for omega in omegas])
+    for fit in [AAA.aaa(1j*omegas,F),AAA.aaa_bands(omegas,F,50.)]:
+        poles,vecs = AAA.get_Potapov_poles_and_vecs(fit)
+        assert len(poles) == len(roots)
+        for root in roots:
+            assert np.amin(abs(root - poles)) < eps
+        vecs_T = Potapov.get_Potapov_vecs(X.T,poles)
+        for vec,vec_T in zip(vecs,vecs_T):
+            assert abs(abs((vec.H*vec_T)[0,0]) - 1.) < 1e-6
+    A,B,C,D = Potapov.get_Potapov_ABCD(poles,vecs)
+    assert A.shape == (len(poles),len(poles))
+
+def test_iter_roots(eps=1e-7):
+    '''
+    The roots and Potapov vectors generated band by band should be the same
+    as the ones found for the whole rectangle at once, and the bands should
+    start from the center frequency.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate')
+    roots_nc = np.asarray(X.roots)
+    for processes in [1,2]:
+        bands = list(X.iter_roots(band_width = 30.,with_vecs = True,
+            processes = processes))
+        centers = [abs(sum(band)) for band,_,_ in bands]
+        assert centers == sorted(centers)
+        roots = np.concatenate([band_roots for _,band_roots,_ in bands])
+        vecs = sum([band_vecs for _,_,band_vecs in bands],[])
+        assert len(roots) == len(roots_nc) == len(vecs)
+        for root in roots_nc:
+            assert np.amin(abs(root - roots)) < eps
+    vecs_all = Potapov.get_Potapov_vecs(X.T,roots)
+    for vec,vec_all in zip(vecs,vecs_all):
+        testing.assert_allclose(vec,vec_all)
+
+def test_roots_checkpoint(eps=1e-7):
+    '''
+    A root search interrupted after some bands should resume from its
+    checkpoint without searching these bands again, and give the same
+    roots. A checkpoint of a different network should be rejected.
+    '''
+    checkpoint = os.path.join(tempfile.mkdtemp(),'roots.npz')
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_grid_roots()
+    roots_all = np.asarray(X.roots)
+
+    bands = X.iter_roots(band_width = 30.,checkpoint = checkpoint)
+    for i in range(3):
+        next(bands)
+    bands.close()
+
+    searched = []
+    search_tile = Roots._grid_roots_rect_packed
+    def counting_search_tile(args):
+        searched.append(args[2])
+        return search_tile(args)
+    Roots._grid_roots_rect_packed = counting_search_tile
+    try:
+        X.make_grid_roots(tile_height = 30.,checkpoint = checkpoint)
+    finally:
+        Roots._grid_roots_rect_packed = search_tile
+    assert len(searched) == 4
+    roots = np.asarray(X.roots)
+    assert len(roots) == len(roots_all)
+    for root in roots_all:
+        assert np.amin(abs(root - roots)) < eps
+
+    Y = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.,
+        r1 = 0.8)
+    testing.assert_raises(Exception,Y.make_grid_roots,tile_height = 30.,
+        checkpoint = checkpoint)
+
+    ## replacing an existing checkpoint, also as on Windows.
+    name = os.name
+    for os_name in [name,'nt']:
+        with open(checkpoint + '.tmp','w') as fh:
+            fh.write(os_name)
+        Time_Delay_Network.os.name = os_name
+        try:
+            Time_Delay_Network._replace_file(checkpoint + '.tmp',checkpoint)
+        finally:
+            Time_Delay_Network.os.name = name
+        assert not os.path.exists(checkpoint + '.tmp')
+        with open(checkpoint) as fh:
+            assert fh.read() == os_name
+
+def test_symmetric_roots(eps=1e-7):
+    '''
+    For a network with real M1 and delays, searching only the upper half plane
+    and mirroring the roots and residues should give the same roots and
+    Potapov vectors as searching the whole rectangle. Counting the roots of a
+    rectangle symmetric about the real axis from the upper half of its
+    boundary should give the same count.
+    '''
+    X = Time_Delay_Network.Example4(max_freq = 300.,max_linewidth = 10.)
+    X.make_roots(method = 'grid')
+    roots = np.asarray(X.roots)
+    X.make_vecs()
+    vecs = X.vecs
+    X.make_roots(method = 'grid',symmetric = True)
+    assert len(X.roots) == len(roots)
+    for root in roots:
+        assert np.amin(abs(root - np.asarray(X.roots))) < eps
+    X.roots = roots.tolist()
+    X.make_vecs(symmetric = True)
+    for vec,sym_vec in zip(vecs,X.vecs):
+        overlap = np.vdot(np.asarray(vec).ravel(),np.asarray(sym_vec).ravel())
+        assert abs(abs(overlap) - 1.) < eps
+    f_frac = lambda z: functions.delay_det_log_der(z,X.M1,X.delays)
+    count = Roots.count_roots_rect(f_frac,-5.,0.,5.,300.,N=2000,
+        conj_symmetric = True)
+    assert abs(count - len(roots)) < 1e-2
+
+    ## the contour search, with a real root.
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'contour')
+    roots = np.asarray(X.roots)
+    X.make_roots(method = 'contour',symmetric = True)
+    sym_roots = np.asarray(X.roots)
+    assert len(sym_roots) == len(roots)
+    assert np.sum(sym_roots.imag == 0) == 1
+    for root in roots:
+        assert np.amin(abs(root - sym_roots)) < eps
+    ## the Potapov vectors depend on the order of the roots, so compare
+    ## them for the same list of roots.
+    X.make_vecs()
+    vecs = X.vecs
+    X.make_vecs(symmetric = True)
+    for vec,sym_vec in zip(vecs,X.vecs):
+        overlap = np.vdot(np.asarray(vec).ravel(),np.asarray(sym_vec).ravel())
+        assert abs(abs(overlap) - 1.) < eps
+
+def _swept_Example3(params):
+    '''Example3 as a function of (r1, tau2), for test_sweep_roots.'''
+    r1,tau2 = params
+    return Time_Delay_Network.Example3(max_freq = 150.,max_linewidth = 3.,
+        r1 = r1,tau2 = tau2)
+
+def test_sweep_roots(eps=1e-7):
+    '''
+    The roots followed along a path of parameters, where roots enter and
+    leave the search rectangle, should be the same as the ones found from
+    scratch for each value, also when segments of the path are swept in
+    parallel.
+    '''
+    params = zip(np.linspace(0.99,0.2,21),np.linspace(0.23,0.4,21))
+    for segments,processes in [(1,1),(2,2)]:
+        roots_list = Parameter_Sweep.sweep_roots(_swept_Example3,params,
+            segments = segments,processes = processes)
+        assert len(roots_list) == len(params)
+        for param,roots in zip(params,roots_list):
+            X = _swept_Example3(param)
+            X.make_roots(method = 'near_commensurate')
+            assert len(roots) == len(X.roots)
+            for root in X.roots:
+                assert np.amin(abs(root - roots)) < eps
+
+def test_merge_found_roots(eps=1e-7):
+    '''
+    Roots found again next to continued roots should not replace them, so
+    that the continued roots keep their velocities.
+    '''
+    roots = np.array([-1.-2j,-1.+1j,-0.5+3j])
+    velocity = np.array([0.1,0.2j,0.3])
+    found = np.r_[roots - 1e-9j,-2.+0.5j,-2.+0.5j+1e-9]
+    all_roots,all_velocity = Parameter_Sweep._merge_found_roots(roots,
+        velocity,found,eps)
+    assert np.all(all_roots == np.r_[-1.-2j,-2.+0.5j,-1.+1j,-0.5+3j])
+    assert np.all(all_velocity == [0.1,0,0.2j,0.3])
+
+def test_pole_sensitivities(h=1e-6,eps=1e-4):
+    '''
+    The analytic sensitivities of the poles to the delays and to the entries
+    of M1 should agree with finite differences, and seeding the perturbation
+    of the roots with them should give the same perturbed roots.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate')
+    roots = np.asarray(X.roots)
+    sensitivities = X.get_pole_sensitivities()
+    n = len(X.delays)
+    assert sensitivities.shape == (len(roots),n + n**2)
+    for k in xrange(n + n**2):
+        delays = np.array(X.delays,dtype=float)
+        M1 = np.array(X.M1,dtype=float)
+        if k < n:
+            delays[k] += h
+        else:
+            M1[(k-n)//n,(k-n)%n] += h
+        new_roots,converged = Roots.newton_batch(
+            lambda z: 1./functions.delay_det_log_der(z,M1,delays),roots)
+        assert converged.all()
+        assert np.amax(abs((new_roots - roots)/h - sensitivities[:,k])
+                       / (1. + abs(sensitivities[:,k]))) < eps
+
+    Ex = Time_Delay_Network.Example1(max_freq = 100.)
+    Ex.run_Potapov()
+    perturb_func = Ex.get_frequency_pertub_func_z(use_lambdify = True)
+    perturbed_roots = []
+    for sensitivities in [None,Ex.get_pole_sensitivities()]:
+        ham = Hamiltonian.Hamiltonian(list(Ex.roots),Ex.spatial_modes,
+            Ex.delays,Omega=np.eye(len(Ex.roots)))
+        chi_nonlin_test = Hamiltonian.Chi_nonlin(delay_indices=[0],
+                    start_nonlin=0,length_nonlin=0.1*consts.c)
+        chi_nonlin_test.refraction_index_func = lambda freq, pol: (
+            1. + abs(freq / (5000*np.pi)) )
+        ham.chi_nonlinearities.append(chi_nonlin_test)
+        converged,counts = ham.perturb_roots_z(perturb_func,vectorized=True,
+                    sensitivities=sensitivities)
+        assert converged.all()
+        perturbed_roots.append(np.asarray(ham.roots))
+    assert np.amax(abs(perturbed_roots[0] - perturbed_roots[1])) < 1e-9
+
+def test_limit_batch(eps=1e-10):
+    '''
+    The residues of T estimated for all the poles in one vectorized call
+    should be the same as those estimated one pole at a time, and
+    Richardson extrapolation should reach the same accuracy with fewer
+    points.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 200.,max_linewidth = 10.)
+    X.make_roots(method = 'near_commensurate')
+    M1 = np.asarray(X.M1)
+    delays = np.asarray(X.delays)
+    def inv_A(z):
+        A,A_der = functions._I_minus_M1_E(z,M1,delays)
+        return la.inv(A)
+    residues = functions.limit_batch(inv_A,X.roots,residue=True,
+        vectorized=True)
+    assert residues.shape == (len(X.roots),) + M1.shape
+    for root,residue in zip(X.roots,residues):
+        single = functions.limit(lambda z: (z-root)*inv_A(z),root)
+        assert np.amax(abs(single - residue)) < eps
+    assert np.amax(abs(functions.limit_batch(inv_A,X.roots,residue=True,
+        vectorized=False) - residues)) < eps
+    extrapolated = functions.limit_batch(inv_A,X.roots,N=2,eps=1e-2,
+        residue=True,richardson=True,vectorized=True)
+    assert np.amax(abs(extrapolated - residues)) < 1e-8
+
+    ## A broadcasting f with its value axes first is not point first.
+    f = lambda z: np.array([[1./z,2.+0*z],[3.+0*z,z]])
+    z0s = [1+1j,2.]
+    expected = [[[0.5-0.5j,2.],[3.,1+1j]],[[0.5,2.],[3.,2.]]]
+    testing.assert_raises(Exception,functions.limit_batch,f,z0s,N=2,
+        richardson=True,vectorized=True)
+    assert np.amax(abs(functions.limit_batch(f,z0s,N=2,richardson=True)
+        - expected)) < 1e-6
+
+def test_new_f_frac_batch(eps=1e-9):
+    '''
+    Subtracting the poles at all the boundary points at once, in small
+    chunks, should agree with new_f_frac_safe point by point, including the
+    points where the limit is used because the value is too large.
+    '''
+    roots = [-0.5+1j,-0.3-2j,-0.7+0.5j]
+    residues = [1.,1.,1.]
+    f_frac = lambda z: sum(1./(z - root) for root in roots) + z**2
+    c = np.asarray(Roots.get_boundary(-0.5,0.,1.,3.,50))
+    zs = np.r_[c,roots[0] + 1e-9]
+    vals = [f_frac(z) for z in zs]
+    max_ok = 1e3
+    batch = Roots.new_f_frac_batch(f_frac,zs,residues,roots,max_ok,vals,
+        chunk_size=7)
+    for z,val,batch_val in zip(zs,vals,batch):
+        single = Roots.new_f_frac_safe(f_frac,z,residues,roots,max_ok,val)
+        assert abs(single - batch_val) < eps
+        assert abs(batch_val - z**2) < 1e-6
+
+def test_spatial_modes_batched(eps=1e-12):
+    '''
+    The spatial modes found with one stacked eigendecomposition should be
+    the same as the eigenvectors of M1*E(root) found one root at a time,
+    normalized with the delays. Without E, the diagonal delay matrix should
+    give the same modes.
+    '''
+    for X in [Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.),
+              Time_Delay_Network.Example5()]:
+        X.make_roots(method = 'grid')
+        modes = functions.spatial_modes(X.roots,X.M1,X.E,delays=X.delays)
+        assert len(modes) == len(X.roots)
+        for root,mode in zip(X.roots,modes):
+            evals,evecs = la.eig(X.M1*X.E(root))
+            vec = evecs[:,np.argmin(abs(1.-evals))]
+            vec /= functions._norm_of_mode(vec,X.delays)
+            assert mode.shape == vec.shape
+            assert np.amax(abs(mode - vec)) < eps
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'grid')
+    modes = functions.spatial_modes(X.roots,X.M1,X.E,delays=X.delays)
+    modes_no_E = functions.spatial_modes(X.roots,X.M1,None,delays=X.delays)
+    for mode,mode_no_E in zip(modes,modes_no_E):
+        assert np.amax(abs(mode - mode_no_E)) < eps
+
+def test_inner_product_matrix(eps=1e-12):
+    '''
+    The broadcasted inner product matrix should agree with the inner
+    products of pairs of modes, be Hermitian, and have a unit diagonal.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'grid')
+    modes = functions.spatial_modes(X.roots,X.M1,X.E,delays=X.delays)
+    ## include a repeated and a nearly repeated root for the
+    ## degenerate-frequency branch, with the default cutoff 1e-7.
+    roots = X.roots + X.roots[:1] + [X.roots[1] + 1e-9j]
+    modes = modes + modes[:2]
+    mat = functions.make_normalized_inner_product_matrix(roots,modes,
+        X.delays,block_size=5)
+    norms = [functions.inner_product_of_two_modes(r,r,v,v,X.delays)
+             for r,v in zip(roots,modes)]
+    for i in range(len(roots)):
+        for j in range(len(roots)):
+            prod = functions.inner_product_of_two_modes(roots[i],roots[j],
+                modes[i],modes[j],X.delays)
+            assert abs(mat[i,j] - prod / np.sqrt(norms[i]*norms[j])) < eps
+    assert np.amax(abs(mat - mat.conj().T)) < eps
+    assert np.amax(abs(np.diag(mat) - 1.)) < eps
+    assert abs(mat[0,-2] - 1.) < eps
+
+def test_sparse_inner_product_matrix(threshold=0.05,eps=1e-12):
+    '''
+    The tiled sparse inner product matrix should keep exactly the entries of
+    the dense matrix above the threshold, and the memory-mapped file should
+    hold the whole dense matrix.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 100.,max_linewidth = 10.)
+    X.make_roots(method = 'grid')
+    modes = functions.spatial_modes(X.roots,X.M1,X.E,delays=X.delays)
+    dense = functions.make_normalized_inner_product_matrix(X.roots,modes,
+        X.delays)
+    filename = os.path.join(tempfile.mkdtemp(),'overlaps.dat')
+    mat = functions.make_sparse_inner_product_matrix(X.roots,modes,X.delays,
+        threshold=threshold,tile_size=4,filename=filename)
+    kept = np.where(abs(dense) >= threshold,dense,0.)
+    assert mat.nnz == np.count_nonzero(kept)
+    assert np.amax(abs(mat.toarray() - kept)) < eps
+    stored = np.memmap(filename,dtype='complex_',shape=dense.shape)
+    assert np.amax(abs(stored - dense)) < eps
+    del stored
+
+    ## the same with a process pool.
+    mat = functions.make_sparse_inner_product_matrix(X.roots,modes,X.delays,
+        threshold=threshold,tile_size=4,filename=filename,processes=2)
+    assert mat.nnz == np.count_nonzero(kept)
+    assert np.amax(abs(mat.toarray() - kept)) < eps
+    stored = np.memmap(filename,dtype='complex_',shape=dense.shape)
+    assert np.amax(abs(stored - dense)) < eps
+    del stored
+
+    mat = functions.make_sparse_inner_product_matrix([],[],X.delays,
+        filename=filename)
+    assert mat.shape == (0,0) and mat.nnz == 0
+    assert os.path.getsize(filename) == 0
+
+def test_phase_weights_batch(eps=1e-12):
+    '''
+    The batched phase matching weights should be the same as those of
+    phase_weight, one key at a time, including when chi has fewer
+    delay_indices than modes in each combination.
+    '''
+    X = Time_Delay_Network.Example3(max_freq = 30.)
+    X.run_Potapov()
+    ham = Hamiltonian.Hamiltonian(X.roots,X.spatial_modes,X.delays,
+        Omega=np.eye(len(X.roots)))
+    for delay_indices,start_nonlin in [([0],0),
+                                       ([0,1,0,1],[0.,0.01,0.,0.02])]:
+        chi = Hamiltonian.Chi_nonlin(delay_indices=delay_indices,
+            start_nonlin=start_nonlin,length_nonlin=0.01*consts.c,
+            refraction_index_func=lambda args: 1. + abs(args[0]) / 100.)
+        weight_keys = ham.make_weight_keys(chi)
+        weights = ham.make_phase_matching_weights(weight_keys,chi)
+        assert len(weights) == len(weight_keys)
+        for comb,pm_arr in weight_keys:
+            weight = ham.phase_weight(comb,pm_arr,chi)
+            assert abs(weights[comb,pm_arr] - weight) <= eps*abs(weight)
+
+def test_pade(eps=1e-12):
+    '''
+    The Pade coefficients from the recurrence should agree with the
+    factorial formula, Pade should accept arrays, and high orders should
+    approximate the exponential.
+    '''
+    f = functions.factorial
+    for n in [1,2,5,10]:
+        coeffs = [float(f(2*n-k) * f(n)) / (f(2*n) * f(k) * f(n-k))
+                  for k in range(n,-1,-1)]
+        assert np.amax(abs(np.array(functions.pade_approx(n)) - coeffs)) < eps
+    zs = np.linspace(-1.,1.,5) + 1j*np.linspace(-10.,10.,5)
+    vals = functions.Pade(12,zs)
+    assert vals.shape == zs.shape
+    for z,val in zip(zs,vals):
+        assert abs(functions.Pade(12,z) - val) < eps
+    assert np.amax(abs(functions.Pade(200,zs) - np.exp(zs))) < 1e-10
+
+def test_pade_ABCD(eps=1e-10):
+    '''
+    The state-space realization of the Pade approximation of each delay
+    should match Pade and the exponential at high order, and the sparse
+    network-level ABCD model should match example6_pade and approximate the
+    transfer function, with all its poles in the left half plane.
+    '''
+    zs = [0.5+3j,1j,20j,1e-3]
+    for n in [1,4,30]:
+        A,B,C,D = functions.pade_state_space(0.2,n)
+        T = functions.state_space_transfer_function(A,B,C,D)
+        for z in zs:
+            assert abs(T(z)[0,0] - functions.Pade(n,-0.2*z)) < eps
+    A,B,C,D = functions.pade_state_space(1.,150)
+    T = functions.state_space_transfer_function(A,B,C,D)
+    assert abs(T(100j)[0,0] - np.exp(-100j)) < eps
+
+    X = Time_Delay_Network.Example3()
+    T_pade = Time_Delay_Network.example6_pade()
+    A,B,C,D = X.get_Pade_ABCD(15)
+    assert A.shape == (15,15)
+    T = functions.state_space_transfer_function(A,B,C,D)
+    for z in zs:
+        assert np.amax(abs(T(z) - T_pade(z,15))) < eps
+    for Ex in [Time_Delay_Network.Example1,Time_Delay_Network.Example2,
+               Time_Delay_Network.Example3,Time_Delay_Network.Example4]:
+        X = Ex()
+        A,B,C,D = X.get_Pade_ABCD(60)
+        T = functions.state_space_transfer_function(A,B,C,D)
+        for z in zs:
+            assert np.amax(abs(T(z) - X.T(z))) < eps
+        assert np.amax(la.eigvals(A.toarray()).real) < 0
+
+    ## E(z) must be diag(exp(-z*delays)), with nonnegative delays.
+    X = Time_Delay_Network.Example2()
+    testing.assert_raises(Exception,X.get_Pade_ABCD,10,X.delays)
+    testing.assert_raises(Exception,X.get_Pade_ABCD,10,[X.delays[0],2*X.delays[0]])
+    testing.assert_raises(Exception,Time_Delay_Network.Example5().get_Pade_ABCD,20)
+
+def test_time_sim_pade():
+    '''
+    A short headless time simulation of the Pade model should run and
+    save its plot.
+    '''
+    backend = plt.get_backend()
+    plt.switch_backend('agg')
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp)
+        Time_Sims.time_sim(Time_Delay_Network.Example3,
+            t1=1.,dt=0.1,pade_order=8)
+        assert os.listdir(tmp) == ['FP_pade8.pdf']
+    finally:
+        os.chdir(cwd)
+        plt.close('all')
+        plt.switch_backend(backend)
+        shutil.rmtree(tmp)
+
+def test_delay_det_exponential_terms(eps=1e-12):
+    '''
+    The exponential polynomial should agree with the sum over principal
+    minors, and with the determinant for many nodes sharing a few delays.
+    '''
+    from itertools import combinations
+    X = Time_Delay_Network.Example3()
+    M1,delays = np.asarray(X.M1),np.asarray(X.delays)
+    terms = {}
+    for size in range(len(delays)+1):
+        for S in combinations(range(len(delays)),size):
+            coeff = (-1)**size * la.det(M1[np.ix_(S,S)]) if size else 1.
+            tau = round(delays[list(S)].sum(),12)
+            terms[tau] = terms.get(tau,0.) + coeff
+    terms = dict((tau,c) for tau,c in terms.items() if abs(c) > eps)
+    coeffs,exponents = functions.delay_det_exponential_terms(M1,delays)
+    testing.assert_allclose(exponents,sorted(terms))
+    testing.assert_allclose(coeffs,[terms[tau] for tau in sorted(terms)],
+        atol=eps)
+
+    M1 = 0.1*np.random.RandomState(0).randn(30,30)
+    delays = [0.1]*10 + [0.25]*20
+    coeffs,exponents = functions.delay_det_exponential_terms(M1,delays)
+    for z in [0.3+2j,-0.5+40j]:
+        assert abs(np.sum(coeffs*np.exp(-z*exponents))
+                   - functions.delay_det(z,M1,delays)) < 1e-10
+    testing.assert_raises(Exception,functions.delay_det_exponential_terms,
+        M1,0.1 + 0.01*np.arange(30))
 
 # def test_delay_perturbations(eps=1e-5):
 #     '''